@@ -1,10 +1,9 @@
 import re
 import io
+import sys
 import base64
-import numpy as np
+import weakref
 import tokenize
-from PIL import Image
-import matplotlib.pyplot as plt
 
 # Code manipulation
 
@@ -92,7 +91,49 @@ def load_code_lines(file_name):
 
 # Image Processing
 
+# numpy, PIL and matplotlib take most of the startup time of run.py, so they
+# are only imported once a value needs them. A value can only be an ndarray
+# if numpy was imported already, so checking sys.modules comes first.
+
+class LazyModule:
+	# Programs run in the globals of run.py, which has all the names of
+	# this module, and some of them use np, plt and Image without importing
+	# them. These stand in for the modules under those names until first
+	# used, then the names are bound to the module itself.
+	def __init__(self, name):
+		self.module_name = name
+
+	def load(self):
+		# the import is not part of the program, and is much slower traced
+		trace = sys.gettrace()
+		sys.settrace(None)
+		try:
+			__import__(self.module_name)
+		finally:
+			sys.settrace(trace)
+		module = sys.modules[self.module_name]
+		for namespace in (globals(), sys.modules["__main__"].__dict__):
+			for (k, v) in list(namespace.items()):
+				if v is self:
+					namespace[k] = module
+		return module
+
+	def __getattr__(self, attr):
+		if attr == "module_name":
+			raise AttributeError(attr)
+		return getattr(self.load(), attr)
+
+	def __repr__(self):
+		return "<module '%s'>" % self.module_name
+
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+plt = LazyModule("matplotlib.pyplot")
+
 def is_ndarray_img(v):
+	np = sys.modules.get("numpy")
+	if np == None:
+		return False
 	return isinstance(v, np.ndarray) and v.dtype.name == 'uint8' and len(v.shape) == 3 and v.shape[2] == 3
 
 def is_list_img(v):
@@ -135,6 +176,7 @@ def pil_to_html(img, **kwargs):
 
 # Convert ndarray to PIL.Image
 def ndarray_to_pil(arr, min_width = None, max_width = None):
+	from PIL import Image
 	img = Image.fromarray(arr)
 	h = img.height
 	w = img.width
@@ -149,6 +191,7 @@ def ndarray_to_pil(arr, min_width = None, max_width = None):
 
 # Convert list of lists to ndarray
 def list_to_ndarray(arr):
+	import numpy as np
 	return np.asarray(arr, dtype=np.uint8)
 
 def ndarray_to_html(arr, **kwargs):
@@ -160,8 +203,110 @@ def list_to_html(arr, **kwargs):
 # Matplotlib
 
 def matplotlib_fig_as_html():
+	import matplotlib.pyplot as plt
 	file_buffer = io.BytesIO()
 	plt.savefig(file_buffer, format = 'png')
 	encoded = base64.b64encode(file_buffer.getvalue())
 	encoded_str = str(encoded)[2:-1]
 	return f"<img src='data:image/png;base64,{encoded_str}' width=400>"
+
+# Value summaries
+
+# Summarizers replace the repr of values that are too big to print at every
+# step, such as large numpy arrays and pandas DataFrames, with a short preview.
+# A summarizer is only tried once the module defining its values has been
+# imported, so that we never import pandas for a program that doesn't use it.
+class Summarizer:
+	def __init__(self, module, matches, summarize, version):
+		self.module = module
+		self.matches = matches
+		self.summarize = summarize
+		# version(v) changes whenever summarize(v) would, and is much cheaper
+		# to compute. It returns None for values that should not be cached.
+		self.version = version
+
+summarizers = []
+
+def register_summarizer(module, matches, summarize, version = lambda v: None):
+	summarizers.append(Summarizer(module, matches, summarize, version))
+
+SUMMARY_MIN_SIZE = 100
+SUMMARY_EDGE_ITEMS = 3
+
+# id(v) -> (weakref to v, version, summary)
+summary_cache = {}
+
+def summarize_value(v):
+	for s in summarizers:
+		if s.module in sys.modules and s.matches(v):
+			return cached_summary(s, v)
+	return None
+
+def cached_summary(s, v):
+	version = s.version(v)
+	if version == None:
+		return s.summarize(v)
+	key = id(v)
+	cached = summary_cache.get(key)
+	if cached != None and cached[0]() is v and cached[1] == version:
+		return cached[2]
+	summary = s.summarize(v)
+	try:
+		ref = weakref.ref(v, lambda _: summary_cache.pop(key, None))
+	except TypeError:
+		return summary
+	summary_cache[key] = (ref, version, summary)
+	return summary
+
+def is_large_ndarray(v):
+	return isinstance(v, sys.modules["numpy"].ndarray) and v.size > SUMMARY_MIN_SIZE and v.dtype.kind in "biuf"
+
+def ndarray_corners(arr):
+	# numpy only reads the items it prints when summarizing
+	return sys.modules["numpy"].array2string(arr, threshold = 0, edgeitems = SUMMARY_EDGE_ITEMS)
+
+def ndarray_version(arr):
+	# Writable arrays can change in place, and anything that would tell
+	# (e.g. a digest of the contents) costs about as much as the summary,
+	# so only arrays that can't change are cached. A read-only view of a
+	# writable array can still change through it.
+	base = arr
+	while isinstance(base, sys.modules["numpy"].ndarray):
+		if base.flags.writeable:
+			return None
+		base = base.base
+	return (arr.shape, arr.dtype.str, arr.strides, arr.ctypes.data)
+
+def ndarray_summary(arr):
+	# reductions don't copy the array, except for nanmean when there are NaNs
+	np = sys.modules["numpy"]
+	mean = arr.mean()
+	nans = 0
+	if arr.dtype.kind == "f" and np.isnan(mean):
+		nans = int(np.count_nonzero(np.isnan(arr)))
+	if nans > 0 and nans < arr.size:
+		(lo, hi, mean) = (np.nanmin(arr), np.nanmax(arr), np.nanmean(arr))
+	else:
+		(lo, hi) = (arr.min(), arr.max())
+	return "ndarray shape=%s dtype=%s\nmin=%s max=%s mean=%s nan=%d\n%s" % (arr.shape, arr.dtype, lo, hi, mean, nans, ndarray_corners(arr))
+
+def is_large_dataframe(v):
+	return isinstance(v, sys.modules["pandas"].DataFrame) and v.size > SUMMARY_MIN_SIZE
+
+def dataframe_edges(df):
+	return (df.head(SUMMARY_EDGE_ITEMS), df.tail(SUMMARY_EDGE_ITEMS))
+
+def dataframe_version(df):
+	# only the rows we show are hashed
+	pd = sys.modules["pandas"]
+	(head, tail) = dataframe_edges(df)
+	edges = pd.util.hash_pandas_object(pd.concat([head, tail]))
+	return (df.shape, tuple(df.columns), tuple(str(t) for t in df.dtypes), tuple(edges))
+
+def dataframe_summary(df):
+	(head, tail) = dataframe_edges(df)
+	dtypes = ", ".join("%s: %s" % (c, t) for (c, t) in df.dtypes.items())
+	return "DataFrame shape=%s\ndtypes: %s\n%s\n...\n%s" % (df.shape, dtypes, head.to_string(), tail.to_string(header = False))
+
+register_summarizer("numpy", is_large_ndarray, ndarray_summary, ndarray_version)
+register_summarizer("pandas", is_large_dataframe, dataframe_summary, dataframe_version)
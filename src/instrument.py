@@ -0,0 +1,206 @@
+import ast
+
+# Rewrites the AST of a program so that it calls back into the tracer,
+# instead of running under a trace function. The calls mirror the events
+# that bdb gets for the same program:
+#
+#   LINE_HOOK(l)            before every statement of line l, at the test of
+#                           while loops, and when an except clause is checked
+#   ITER_HOOK(l, it)        wraps the iterable of for loops, to get an event
+#                           at the loop header before every fetch but the first
+#   CLASS_HOOK(l)           at the start of class bodies
+#   DECORATE_HOOK(...)      wraps decorators, for the events at the decorator
+#                           and def lines around their calls
+#   RETURN_HOOK(v)          wraps the value of return statements
+#   YIELD_HOOK(v)           wraps the value of yield expressions
+#   UNWIND_HOOK()           when an exception leaves a frame
+#   EXIT_HOOK()             when a frame ends, either way
+#
+# Line numbers given to the hooks are 0-based. The Instrumenter also keeps
+# the structure the loop bookkeeping needs: the lines of loops and of their
+# bodies, breaks and returns.
+
+LINE_HOOK = "__run_py_line__"
+ITER_HOOK = "__run_py_iter__"
+CLASS_HOOK = "__run_py_class__"
+DECORATE_HOOK = "__run_py_decorate__"
+RETURN_HOOK = "__run_py_return__"
+YIELD_HOOK = "__run_py_yield__"
+UNWIND_HOOK = "__run_py_unwind__"
+EXIT_HOOK = "__run_py_exit__"
+
+def hook_call(name, *args):
+	return ast.Call(func = ast.Name(id = name, ctx = ast.Load()), args = list(args), keywords = [])
+
+def line_hook(lineno):
+	return hook_call(LINE_HOOK, ast.Constant(lineno - 1))
+
+def line_hook_stmt(lineno):
+	return ast.Expr(line_hook(lineno))
+
+def line_hook_before(lineno, expr):
+	# line_hook(l) or expr, as hooks return None
+	return ast.BoolOp(op = ast.Or(), values = [line_hook(lineno), expr])
+
+def is_docstring(stmt):
+	return isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant) and isinstance(stmt.value.value, str)
+
+class Instrumenter(ast.NodeTransformer):
+	def __init__(self):
+		# 0-based line of each loop header, to the (first, last) lines of its body
+		self.loops = {}
+		self.breaks = set()
+		self.returns = set()
+		# ids of the docstring nodes, which have no events and must stay
+		# the first statement of their body
+		self.docstrings = set()
+		# whether we are directly in a class body, whose statements are not traced
+		self.in_class = [False]
+
+	def instrument(self, root):
+		self.mark_docstring(root.body)
+		root = self.generic_visit(root)
+		# __future__ imports have to stay at the top of the module
+		n = 0
+		while n < len(root.body) and (id(root.body[n]) in self.docstrings or (isinstance(root.body[n], ast.ImportFrom) and root.body[n].module == "__future__")):
+			n = n + 1
+		body = root.body[n:]
+		if len(body) == 0:
+			body = [ast.Pass()]
+		root.body = root.body[:n] + self.frame_body(body, body[-1])
+		return ast.fix_missing_locations(root)
+
+	def mark_docstring(self, body):
+		if len(body) > 0 and is_docstring(body[0]):
+			self.docstrings.add(id(body[0]))
+
+	def frame_body(self, body, last):
+		# try:
+		#     body
+		# except BaseException:
+		#     UNWIND_HOOK()
+		#     raise
+		# finally:
+		#     EXIT_HOOK()
+		unwind = ast.ExceptHandler(
+			type = ast.Name(id = "BaseException", ctx = ast.Load()),
+			name = None,
+			body = [ast.Expr(hook_call(UNWIND_HOOK)), ast.Raise()])
+		node = ast.Try(body = body, handlers = [unwind], orelse = [], finalbody = [ast.Expr(hook_call(EXIT_HOOK))])
+		return [ast.copy_location(node, last)]
+
+	def visit(self, node):
+		if not isinstance(node, ast.stmt):
+			return ast.NodeTransformer.visit(self, node)
+		first_lineno = node.lineno
+		if hasattr(node, "decorator_list") and len(node.decorator_list) > 0:
+			first_lineno = node.decorator_list[0].lineno
+		has_event = not (self.in_class[-1] or isinstance(node, (ast.While, ast.Global, ast.Nonlocal)) or id(node) in self.docstrings)
+		node = ast.NodeTransformer.visit(self, node)
+		if not has_event:
+			return node
+		return [ast.copy_location(line_hook_stmt(first_lineno), node), node]
+
+	def visit_body(self, node, in_class):
+		self.in_class.append(in_class)
+		self.mark_docstring(node.body)
+		node = self.generic_visit(node)
+		self.in_class.pop()
+		return node
+
+	def visit_FunctionDef(self, node):
+		self.decorate(node)
+		node = self.visit_body(node, False)
+		body = node.body
+		doc = []
+		if id(body[0]) in self.docstrings:
+			doc = body[:1]
+			body = body[1:]
+		if len(body) == 0:
+			body = [ast.copy_location(ast.Pass(), node)]
+		node.body = doc + self.frame_body(body, body[-1])
+		return node
+
+	def visit_AsyncFunctionDef(self, node):
+		return self.visit_FunctionDef(node)
+
+	def visit_ClassDef(self, node):
+		self.decorate(node)
+		node = self.visit_body(node, True)
+		n = 1 if id(node.body[0]) in self.docstrings else 0
+		node.body.insert(n, ast.copy_location(ast.Expr(hook_call(CLASS_HOOK, ast.Constant(node.lineno - 1))), node))
+		return node
+
+	def decorate(self, node):
+		# For @d def f, bdb gets events at the lines of d, f, d (calling d),
+		# and f (binding the result). The first one is the statement's own
+		# line event.
+		decorators = node.decorator_list
+		n = len(decorators)
+		for i in range(n):
+			d = decorators[i]
+			if i > 0:
+				d = line_hook_before(d.lineno, d)
+			args = [ast.Constant(decorators[i].lineno - 1), ast.Constant(node.lineno - 1), ast.Constant(i == n - 1), ast.Constant(i == 0), d]
+			decorators[i] = ast.copy_location(hook_call(DECORATE_HOOK, *args), decorators[i])
+
+	def visit_Lambda(self, node):
+		return node
+
+	def visit_While(self, node):
+		self.add_loop(node)
+		node = self.generic_visit(node)
+		if self.in_class[-1]:
+			return node
+		node.test = ast.copy_location(line_hook_before(node.lineno, node.test), node.test)
+		return node
+
+	def visit_For(self, node):
+		self.add_loop(node)
+		node = self.generic_visit(node)
+		if self.in_class[-1]:
+			return node
+		node.iter = ast.copy_location(hook_call(ITER_HOOK, ast.Constant(node.lineno - 1), node.iter), node.iter)
+		return node
+
+	def add_loop(self, node):
+		self.loops[node.lineno - 1] = (node.body[0].lineno - 1, node.body[-1].end_lineno - 1)
+
+	def visit_With(self, node):
+		# bdb gets an event at the with line again when leaving the block
+		node = self.generic_visit(node)
+		if self.in_class[-1]:
+			return node
+		exit = ast.copy_location(line_hook_stmt(node.lineno), node)
+		node.body = [ast.copy_location(ast.Try(body = node.body, handlers = [], orelse = [], finalbody = [exit]), node)]
+		return node
+
+	def visit_AsyncWith(self, node):
+		return self.visit_With(node)
+
+	def visit_ExceptHandler(self, node):
+		node = self.generic_visit(node)
+		if self.in_class[-1]:
+			return node
+		if node.type == None:
+			node.body.insert(0, ast.copy_location(line_hook_stmt(node.lineno), node))
+		else:
+			node.type = ast.copy_location(line_hook_before(node.lineno, node.type), node.type)
+		return node
+
+	def visit_Break(self, node):
+		self.breaks.add(node.lineno - 1)
+		return node
+
+	def visit_Return(self, node):
+		self.returns.add(node.lineno - 1)
+		node = self.generic_visit(node)
+		value = node.value if node.value != None else ast.copy_location(ast.Constant(None), node)
+		node.value = ast.copy_location(hook_call(RETURN_HOOK, value), value)
+		return node
+
+	def visit_Yield(self, node):
+		node = self.generic_visit(node)
+		value = node.value if node.value != None else ast.copy_location(ast.Constant(None), node)
+		node.value = ast.copy_location(hook_call(YIELD_HOOK, value), value)
+		return node
@@ -1,9 +1,20 @@
+# first, to time the imports that follow (see startup.py)
+import startup
 import ast
 import bdb
+import contextlib
 import ctypes
+import heapq
+import dis
+import hashlib
+import itertools
 import json
 import os
+import signal
 import sys
+import threading
+from time import perf_counter, perf_counter_ns
+import traceback
 import types
 
 from core import *
@@ -35,8 +46,653 @@ def remove_R(lineno):
 	else:
 		return lineno
 
+def env_flag(name):
+	return os.environ.get(name, "") not in ("", "0")
+
+def env_int(name, default = None):
+	value = os.environ.get(name, "")
+	if value == "":
+		return default
+	return int(value)
+
+def env_float(name, default = None):
+	value = os.environ.get(name, "")
+	if value == "":
+		return default
+	return float(value)
+
+class RunOptions:
+	def __init__(self, stats = None, call_depth = None, trace_store = False, history = False, focus = None, loop_summary = None, backend = "bdb", limits = None, scenarios = None, examples = None, example_workers = None, sampler = None, diff = None, profile = None, memory = None):
+		# Optional RunStats, only filled in when stats are requested
+		self.stats = stats
+		# When set, envs of calls deeper than call_depth are left out of
+		# run_time_data and written to <file>.calls, to be loaded on demand
+		self.call_depth = call_depth
+		# When set, run_time_data is also written to the indexed store
+		# <file>.trace (see trace_store.py)
+		self.trace_store = trace_store
+		# When set, a "history" section records where each variable changed
+		self.history = history
+		# Optional FocusRegion: only the code around it is traced
+		self.focus = focus
+		# When set, loops only keep full rows for sampled iterations (see
+		# LoopSummary), and a "loop_summary" section aggregates all of them
+		self.loop_summary = loop_summary
+		# "bdb" traces with a trace function, "ast" instruments the
+		# program instead (see InstrumentedLogger)
+		self.backend = backend
+		# RunLimits of the run, which also handle cancellation
+		self.limits = limits if limits != None else RunLimits()
+		# Optional Scenarios, when the values file has a list of them
+		self.scenarios = scenarios
+		# Optional dict from example id to {"function": name, "args": [exprs]},
+		# calls traced after the run in a pool of example_workers processes
+		# (see run_examples)
+		self.examples = examples
+		self.example_workers = example_workers
+		# Optional Sampler, which only traces the program in short bursts
+		self.sampler = sampler
+		# When set, the id of the run the editor has: only the lines that
+		# changed since that run are sent (see diff_run_time_data)
+		self.diff = diff
+		# Optional LineProfile, for a "profile" section with the hits and
+		# time of every line
+		self.profile = profile
+		# Optional MemoryTrace, which adds the memory allocated by the
+		# previous step to every env
+		self.memory = memory
+
+	@staticmethod
+	def from_environ():
+		return RunOptions(
+			stats = RunStats() if env_flag("RUNPY_STATS") else None,
+			call_depth = env_int("RUNPY_CALL_DEPTH"),
+			trace_store = env_flag("RUNPY_TRACE_STORE"),
+			history = env_flag("RUNPY_HISTORY"),
+			focus = FocusRegion.from_environ(),
+			loop_summary = env_int("RUNPY_LOOP_SUMMARY"),
+			backend = os.environ.get("RUNPY_BACKEND", "bdb"),
+			limits = RunLimits.from_environ(),
+			examples = load_examples(os.environ.get("RUNPY_EXAMPLES", "")),
+			example_workers = env_int("RUNPY_EXAMPLE_WORKERS"),
+			sampler = Sampler.from_environ(),
+			diff = os.environ.get("RUNPY_DIFF") or None,
+			profile = LineProfile.from_environ(),
+			memory = MemoryTrace() if env_flag("RUNPY_MEMORY_TRACE") else None)
+
+def load_examples(file):
+	# the file has a dict from id to example, or a list of examples, whose
+	# ids are their indices
+	if file == "":
+		return None
+	with open(file) as f:
+		examples = json.load(f)
+	if isinstance(examples, list):
+		examples = {str(i): example for (i, example) in enumerate(examples)}
+	return examples
+
+class RunStats:
+	def __init__(self):
+		self.phases = {}
+		self.events = 0
+		self.repr_calls = 0
+		self.repr_bytes = {}
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = perf_counter()
+		try:
+			yield
+		finally:
+			self.add_time(name, perf_counter() - start)
+
+	def add_time(self, name, secs):
+		self.phases[name] = self.phases.get(name, 0) + secs
+
+	def add_repr(self, varname, r):
+		self.repr_bytes[varname] = self.repr_bytes.get(varname, 0) + len(r)
+
+	def to_json(self):
+		# note: "repr" and "image" are measured inside "trace", so they
+		# are not to be added on top of it
+		return {
+			"phases_ms": {k: round(v * 1000, 3) for k, v in self.phases.items()},
+			"events": self.events,
+			"repr_calls": self.repr_calls,
+			"repr_bytes": self.repr_bytes,
+		}
+
+# Return code of runs that were stopped by a limit or cancelled, whose
+# run_time_data only has what was traced until then
+STOPPED_RETURN_CODE = 3
+
+class RunStopped(BaseException):
+	# Raised when a stopped run does not get to a line boundary in time.
+	# It is not an Exception, so that user code does not catch it by mistake.
+	pass
+
+class RunLimits:
+	# Stops the run when it goes over its wall clock, cpu or memory limit, or
+	# when run.py gets SIGTERM or SIGINT. The tracer checks should_stop() at
+	# every line and return, and stops there, so that the trace so far can
+	# still be written out. If the program doesn't get to a line in
+	# GRACE_SECONDS (e.g. it is in a long library call, or in code that is
+	# not traced), the next signal raises RunStopped wherever it is. A
+	# cancelled run gets that signal from a timer, and if RunStopped doesn't
+	# end it either, the default action of the following one does. Signals
+	# are only handled between bytecodes though, so a single long C call
+	# can't be stopped this way: for the cpu limit, the kernel kills the
+	# process HARD_CPU_SECONDS after the limit, without any output.
+	GRACE_SECONDS = 1
+	HARD_CPU_SECONDS = 5
+
+	def __init__(self, timeout = None, cpu = None, memory = None):
+		# in seconds, cpu seconds and MB respectively
+		self.timeout = timeout
+		self.cpu = cpu
+		self.memory = memory
+		self.deadline = None
+		self.stop_reason = None
+		self.saved_handlers = {}
+		self.saved_rlimits = {}
+
+	@staticmethod
+	def from_environ():
+		return RunLimits(
+			timeout = env_float("RUNPY_TIMEOUT"),
+			cpu = env_int("RUNPY_CPU_LIMIT"),
+			memory = env_int("RUNPY_MEMORY_LIMIT"))
+
+	def start(self):
+		self.handle(signal.SIGTERM, "cancelled")
+		self.handle(signal.SIGINT, "cancelled")
+		if self.timeout != None:
+			self.deadline = perf_counter() + self.timeout
+			self.handle(signal.SIGALRM, "timeout")
+			signal.setitimer(signal.ITIMER_REAL, self.timeout, self.GRACE_SECONDS)
+		if self.cpu != None or self.memory != None:
+			import resource
+			if self.cpu != None:
+				# past the soft limit, the kernel sends SIGXCPU every second
+				self.handle(signal.SIGXCPU, "cpu")
+				used = resource.getrusage(resource.RUSAGE_SELF)
+				soft = int(used.ru_utime + used.ru_stime) + self.cpu
+				self.set_rlimit(resource.RLIMIT_CPU, soft, soft + self.HARD_CPU_SECONDS)
+			if self.memory != None:
+				# the limit is on top of what run.py itself uses
+				self.set_rlimit(resource.RLIMIT_AS, address_space_size() + self.memory * 1024 * 1024)
+
+	def stop(self):
+		if signal.SIGALRM in self.saved_handlers:
+			signal.setitimer(signal.ITIMER_REAL, 0)
+		if len(self.saved_rlimits) > 0:
+			import resource
+			for (limit, value) in self.saved_rlimits.items():
+				resource.setrlimit(limit, value)
+		for (signum, handler) in self.saved_handlers.items():
+			signal.signal(signum, handler)
+		self.saved_handlers = {}
+		self.saved_rlimits = {}
+
+	def handle(self, signum, reason):
+		def handler(signum, frame):
+			if self.stop_reason != None:
+				raise RunStopped(self.stop_reason)
+			self.stop_reason = reason
+			if reason == "cancelled":
+				self.end_soon()
+		self.saved_handlers[signum] = signal.signal(signum, handler)
+
+	def end_soon(self):
+		# the editor sends a single SIGTERM, so the grace period of a
+		# cancelled run is timed here
+		def stop(signum, frame):
+			signal.signal(signal.SIGALRM, signal.SIG_DFL)
+			raise RunStopped("cancelled")
+		handler = signal.signal(signal.SIGALRM, stop)
+		self.saved_handlers.setdefault(signal.SIGALRM, handler)
+		signal.setitimer(signal.ITIMER_REAL, self.GRACE_SECONDS, self.GRACE_SECONDS)
+
+	def set_rlimit(self, limit, soft, hard = None):
+		# Only the soft limit is restored by stop(), as a process can't raise
+		# its hard limits
+		import resource
+		(old_soft, old_hard) = resource.getrlimit(limit)
+		if hard == None:
+			hard = old_hard
+		elif old_hard != resource.RLIM_INFINITY:
+			hard = min(hard, old_hard)
+		if hard != resource.RLIM_INFINITY:
+			soft = min(soft, hard)
+			if old_soft == resource.RLIM_INFINITY or old_soft > hard:
+				old_soft = hard
+		self.saved_rlimits[limit] = (old_soft, hard)
+		resource.setrlimit(limit, (soft, hard))
+
+	def should_stop(self):
+		if self.stop_reason != None:
+			return True
+		if self.deadline != None and perf_counter() > self.deadline:
+			self.stop_reason = "timeout"
+			return True
+		return False
+
+	def stopped_by(self, exception):
+		# a MemoryError under a memory limit means we hit the limit
+		if self.memory != None and isinstance(exception, MemoryError):
+			self.stop_reason = "memory"
+			return True
+		return False
+
+def address_space_size():
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError):
+		return 0
+
+def compile_values(values):
+	# {"(lineno,time)": {varname: expr}} -> {time: (lineno, line_time, {varname: code})}
+	# Expressions that don't compile are kept as strings, so that eval
+	# raises when (and if) they are used.
+	injections = {}
+	for (line_time, env) in values.items():
+		(lineno, time) = line_time[1:-1].rsplit(",", 1)
+		codes = {}
+		for (varname, expr) in env.items():
+			if isinstance(expr, str):
+				try:
+					codes[varname] = compile(expr, "<value>", "eval")
+				except SyntaxError:
+					codes[varname] = expr
+		injections[int(time)] = (lineno, line_time, codes)
+	return injections
+
+class Scenarios:
+	# Runs several value injection scenarios (each one a values dict) from
+	# one execution of their common prefix: when the trace gets to the first
+	# injection point of any of them, the process forks a child for each
+	# scenario but the first, which the parent goes on with. Scenario i > 0
+	# writes its results to <file>.<i>.out (and .calls, .trace).
+	def __init__(self, scenarios):
+		self.injections = [compile_values(values) for values in scenarios]
+		points = [(time, lineno) for injections in self.injections for (time, (lineno, _, _)) in injections.items()]
+		self.checkpoint = min(points) if len(points) > 0 else None
+		self.forked = False
+		self.index = 0
+		self.children = []
+
+	def at_checkpoint(self, time, lineno):
+		return not self.forked and self.checkpoint == (time, str(lineno))
+
+	def fork(self):
+		# returns the injections of the scenario this process runs
+		self.forked = True
+		sys.stdout.flush()
+		sys.stderr.flush()
+		for i in range(1, len(self.injections)):
+			pid = os.fork()
+			if pid == 0:
+				self.index = i
+				self.children = []
+				break
+			self.children.append(pid)
+		return self.injections[self.index]
+
+	def output_base(self, file):
+		if self.index == 0:
+			return file
+		return "%s.%d" % (file, self.index)
+
+	def outputs(self, file):
+		# scenarios that were not forked ran the same as the first one
+		if not self.forked:
+			return [file + ".out"] * len(self.injections)
+		return [file + ".out"] + ["%s.%d.out" % (file, i) for i in range(1, len(self.injections))]
+
+	def cancel(self):
+		for pid in self.children:
+			os.kill(pid, signal.SIGTERM)
+		self.wait()
+
+	def wait(self):
+		# a cancelled parent cancels the children too
+		def forward(signum, frame):
+			for pid in self.children:
+				os.kill(pid, signum)
+		handlers = {signum: signal.signal(signum, forward) for signum in [signal.SIGTERM, signal.SIGINT]}
+		try:
+			for pid in self.children:
+				os.waitpid(pid, 0)
+		finally:
+			for (signum, handler) in handlers.items():
+				signal.signal(signum, handler)
+
+# Code flags of frames that can be suspended and resumed (generators and coroutines)
+# (CO_GENERATOR, CO_COROUTINE and CO_ASYNC_GENERATOR, without importing inspect)
+SUSPENDABLE_CODE_FLAGS = 0x20 | 0x80 | 0x200
+YIELD_VALUE = dis.opmap["YIELD_VALUE"]
+
+class ChangeHistory:
+	def __init__(self):
+		# distinct reprs, indexed by value id
+		self.values = []
+		self.value_ids = {}
+		# varname -> list of [time, lineno, frame id, value id], in time
+		# order, with one entry each time the variable changes in a frame
+		self.changes = {}
+		# frame id -> {varname: value id} for live frames
+		self.last = {}
+		# frame id -> the line that last ran in the frame, which is the one
+		# that made the changes seen at its next env
+		self.lines = {}
+
+	def value_id(self, r):
+		vid = self.value_ids.get(r)
+		if vid == None:
+			vid = len(self.values)
+			self.value_ids[r] = vid
+			self.values.append(r)
+		return vid
+
+	def record(self, time, lineno, fid, varname, r):
+		# the values at the env of lineno, which is about to run. The
+		# arguments of a call are seen at its first line.
+		vid = self.value_id(r)
+		if not fid in self.last:
+			self.last[fid] = {}
+		frame_last = self.last[fid]
+		if frame_last.get(varname) != vid:
+			frame_last[varname] = vid
+			if not varname in self.changes:
+				self.changes[varname] = []
+			self.changes[varname].append([time, self.lines.get(fid, remove_R(lineno)), fid, vid])
+
+	def ran(self, fid, lineno):
+		# called after the values of every env, recorded or not
+		self.lines[fid] = remove_R(lineno)
+
+	def forget_frame(self, fid):
+		self.last.pop(fid, None)
+		self.lines.pop(fid, None)
+
+	def to_json(self):
+		return {"values": self.values, "vars": self.changes}
+
+class FocusRegion:
+	def __init__(self, ranges = [], functions = []):
+		# ranges are (first, last) 1-based inclusive line numbers, as in the
+		# editor, functions are names of functions whose body is in focus
+		self.ranges = ranges
+		self.functions = functions
+		# 0-based line numbers (as in run_time_data), see resolve
+		self.lines = set()
+		self.code_cache = {}
+
+	@staticmethod
+	def from_environ():
+		# RUNPY_FOCUS="first-last,..." and/or RUNPY_FOCUS_FUNCTIONS="name,..."
+		ranges = []
+		for r in os.environ.get("RUNPY_FOCUS", "").split(","):
+			if r.strip() != "":
+				bounds = r.split("-")
+				ranges.append((int(bounds[0]), int(bounds[-1])))
+		functions = [f.strip() for f in os.environ.get("RUNPY_FOCUS_FUNCTIONS", "").split(",") if f.strip() != ""]
+		if len(ranges) == 0 and len(functions) == 0:
+			return None
+		return FocusRegion(ranges, functions)
+
+	def resolve(self, root):
+		# computes the focused lines, given the ast of the program
+		for (first, last) in self.ranges:
+			self.lines.update(range(first - 1, last))
+		for node in ast.walk(root):
+			if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name in self.functions:
+				self.lines.update(range(node.lineno - 1, node.end_lineno))
+
+	def has_line(self, lineno):
+		return remove_R(lineno) in self.lines
+
+	def covers(self, code):
+		# whether code has any of its own lines (not counting nested
+		# functions) in focus
+		result = self.code_cache.get(code)
+		if result == None:
+			result = any(l != None and l - 1 in self.lines for (_, l) in dis.findlinestarts(code))
+			self.code_cache[code] = result
+		return result
+
+class DistinctSketch:
+	# k minimum values sketch: estimates the number of distinct values
+	# from the k smallest hashes seen (exact while there are fewer than k)
+	def __init__(self, k = 64):
+		self.k = k
+		# max-heap of the k smallest hashes, as negated values
+		self.heap = []
+		self.hashes = set()
+
+	def add(self, r):
+		h = (hash(r) & 0xFFFFFFFFFFFFFFFF) / 2**64
+		if h in self.hashes:
+			return
+		if len(self.heap) < self.k:
+			heapq.heappush(self.heap, -h)
+			self.hashes.add(h)
+		elif h < -self.heap[0]:
+			self.hashes.discard(-heapq.heapreplace(self.heap, -h))
+			self.hashes.add(h)
+
+	def estimate(self):
+		if len(self.heap) < self.k:
+			return len(self.heap)
+		return int((self.k - 1) / -self.heap[0])
+
+class VarSummary:
+	__slots__ = ("count", "first", "last", "min", "max", "distinct", "type", "types")
+
+	# at most this many type changes are kept
+	MAX_TYPES = 16
+
+	def __init__(self):
+		self.count = 0
+		self.first = None
+		self.last = None
+		self.min = None
+		self.max = None
+		self.distinct = DistinctSketch()
+		self.type = None
+		# [iter, type name] of the iterations where the type changed
+		self.types = []
+
+	def add(self, iter, v, r):
+		# r is None for values that were not printed (see
+		# Logger.summary_inputs)
+		self.count += 1
+		if r != None and self.first == None:
+			self.first = r
+		if r != None:
+			self.last = r
+		if isinstance(v, (int, float)) and not isinstance(v, bool):
+			if self.min == None or v < self.min:
+				self.min = v
+			if self.max == None or v > self.max:
+				self.max = v
+		if r != None:
+			self.distinct.add(r)
+		t = type(v).__name__
+		if t != self.type:
+			self.type = t
+			if len(self.types) < VarSummary.MAX_TYPES:
+				self.types.append([iter, t])
+
+	def to_json(self):
+		# min and max are reprs, like all the other values
+		return {
+			"count": self.count,
+			"first": self.first,
+			"last": self.last,
+			"min": None if self.min == None else repr(self.min),
+			"max": None if self.max == None else repr(self.max),
+			"distinct": self.distinct.estimate(),
+			"types": self.types,
+		}
+
+class LoopSummary:
+	def __init__(self, sample):
+		# full rows are only kept for the first `sample` iterations of a
+		# loop, and for the iterations that are powers of 2 after that
+		self.sample = sample
+		# loop lineno -> {varname: VarSummary}, over all the iterations
+		self.loops = {}
+
+	def sampled(self, loops):
+		for l in loops:
+			if l.iter >= self.sample and (l.iter & (l.iter - 1)) != 0:
+				return False
+		return True
+
+	def add(self, loop, varname, v, r):
+		if not loop.lineno in self.loops:
+			self.loops[loop.lineno] = {}
+		variables = self.loops[loop.lineno]
+		if not varname in variables:
+			variables[varname] = VarSummary()
+		variables[varname].add(loop.iter, v, r)
+
+	def to_json(self):
+		return {str(lineno): {k: v.to_json() for k, v in variables.items()} for lineno, variables in self.loops.items()}
+
+class Sampler:
+	# Sampling mode: the program runs without tracing, and every interval
+	# seconds of cpu time, tracing is turned on for a burst of burst seconds
+	# (see Logger.start_burst), which bounds its overhead to about
+	# burst / interval. The timer is on cpu time, as the wall clock one is
+	# taken by RunLimits.
+	def __init__(self, interval, burst):
+		self.interval = interval
+		self.burst = burst
+		# end of the current burst, None between bursts
+		self.burst_end = None
+		self.bursts = 0
+
+	@staticmethod
+	def from_environ():
+		# RUNPY_SAMPLE="interval_ms,burst_ms"
+		value = os.environ.get("RUNPY_SAMPLE", "")
+		if value == "":
+			return None
+		(interval, burst) = [float(ms) / 1000 for ms in value.split(",")]
+		return Sampler(interval, burst)
+
+	def begin(self):
+		self.bursts += 1
+		self.burst_end = perf_counter() + self.burst
+
+	def burst_on(self):
+		return self.burst_end != None and perf_counter() < self.burst_end
+
+class LineProfile:
+	# Line profiler mode: hit counts and self time of every line, and of
+	# every function, measured between the line and return events of the
+	# program (see Logger.profile_enter). When capture is off, no envs are
+	# recorded at all.
+	def __init__(self, capture):
+		self.capture = capture
+		# lineno -> [hits, self ns]
+		self.lines = {}
+		# qualified name -> [calls, hits, self ns]
+		self.functions = {}
+		# id of every frame being run -> (lineno, function) of its last line
+		self.frame_lines = {}
+		self.overhead = 0
+
+	@staticmethod
+	def from_environ():
+		# RUNPY_LINE_PROFILE=1, or "only" to not capture values
+		value = os.environ.get("RUNPY_LINE_PROFILE", "")
+		if value == "":
+			return None
+		return LineProfile(value != "only")
+
+	def calibrate(self, n = 1000):
+		probe = OverheadProbe()
+		bdb.Bdb.run(probe, "for i in range(%d):\n\tpass\n" % n, {})
+		deltas = sorted(t1 - t0 for (t0, t1) in zip(probe.times, probe.times[1:]))
+		self.overhead = deltas[len(deltas) // 2]
+
+	def line(self, fid, lineno, function):
+		if not fid in self.frame_lines:
+			self.functions.setdefault(function, [0, 0, 0])[0] += 1
+		self.frame_lines[fid] = (lineno, function)
+		self.lines.setdefault(lineno, [0, 0])[0] += 1
+		self.functions[function][1] += 1
+
+	def add_time(self, at, ns):
+		(lineno, function) = at
+		ns = max(0, ns - self.overhead)
+		self.lines[lineno][1] += ns
+		self.functions[function][2] += ns
+
+	def to_json(self):
+		return {
+			"overhead_ns": self.overhead,
+			"lines": {str(lineno): hits_time for (lineno, hits_time) in sorted(self.lines.items())},
+			"functions": self.functions,
+		}
+
+class MemoryTrace:
+	# Net and peak memory allocated by the program in a step, from the
+	# counters of tracemalloc. Each thread logger keeps the value of the
+	# counter at the end of its last event as its baseline (see
+	# Logger.step_done), so what the tracer allocates in between is left
+	# out. The counters are per process though: the numbers of a thread
+	# include what other threads allocated meanwhile, and any event resets
+	# the peak.
+	def __init__(self):
+		self.started = False
+
+	def start(self):
+		import tracemalloc
+		# RUNPY_PROFILE=tracemalloc may be tracing already
+		if not tracemalloc.is_tracing():
+			# one frame per allocation, as only the counters are used
+			tracemalloc.start(1)
+			self.started = True
+
+	def stop(self):
+		import tracemalloc
+		if self.started:
+			tracemalloc.stop()
+			self.started = False
+
+	def since(self, baseline):
+		import tracemalloc
+		(current, peak) = tracemalloc.get_traced_memory()
+		return (current - baseline, max(peak - baseline, 0))
+
+	def reset(self):
+		# returns the new baseline
+		import tracemalloc
+		tracemalloc.reset_peak()
+		return tracemalloc.get_traced_memory()[0]
+
+class CallInfo:
+	__slots__ = ("parent", "name", "depth")
+
+	def __init__(self, parent, name, depth):
+		# id of the calling frame, None for the top-level frame
+		self.parent = parent
+		self.name = name
+		self.depth = depth
+
+	def to_json(self):
+		return {"parent": self.parent, "name": self.name, "depth": self.depth}
+
 class LoopInfo:
+	__slots__ = ("frame", "lineno", "indent", "iter")
+
 	def __init__(self, frame, lineno, indent):
+		# id of the frame (see Logger.frame_id), not the frame itself
 		self.frame = frame
 		self.lineno = lineno
 		self.indent = indent
@@ -45,32 +701,332 @@ class LoopInfo:
 	def __str__(self):
 		return f'iter {self.iter}, frame {self.frame} at line {self.lineno} with indent {self.indent}'
 
+class Clock:
+	# Time steps of the run, shared by the loggers of all its threads.
+	# next() on a count is atomic, so threads get distinct times without
+	# a lock; time is the next step, for the checks made before an env.
+	def __init__(self):
+		self.counter = itertools.count()
+		self.time = 0
+		# steps of loops that were not recorded (see Logger.should_record),
+		# which have no time, so that envs stay consecutive, but still
+		# count towards the steps limit
+		self.skip_counter = itertools.count()
+		self.skipped = 0
+		# set when the run stopped at the steps limit
+		self.limit_reached = False
+
+	def tick(self):
+		t = next(self.counter)
+		self.time = t + 1
+		return t
+
+	def skip(self):
+		self.skipped = next(self.skip_counter) + 1
+
+	def steps(self):
+		return self.time + self.skipped
+
 class Logger(bdb.Bdb):
-	def __init__(self, lines, writes, values = []):
+	def __init__(self, lines, writes, values = [], options = None):
 		bdb.Bdb.__init__(self)
+		if options == None:
+			options = RunOptions()
 		self.lines = lines
 		self.writes = writes
-		self.time = 0
-		self.prev_env = None
+		self.clock = Clock()
+		self.preexisting_locals = None
+
+		# Envs refer to frames through small integer ids, so that we don't
+		# keep every traced frame (and all its locals) alive until the end
+		# of the run. frame_ids maps id(frame) of live frames to their code
+		# and id. An address is only unique while the frame is alive, so
+		# entries are dropped when their frame ends (see forget_frame), and
+		# all of them between sampling bursts, as returns are missed then.
+		# Every frame is a call, so frame ids double as call ids: calls
+		# maps them to the CallInfo of the frame.
+		self.frame_ids = {}
+		self.calls = {}
+		self.frame_counter = itertools.count()
+
+		# Values to inject, from a dict from (lineno, time) to a dict of
+		# varname: value, see compile_values
+		self.injections = compile_values(values) if isinstance(values, dict) else {}
+		self.scenarios = options.scenarios
+
+		self.options = options
+		self.stats = options.stats
+		self.limits = options.limits
+		self.history = ChangeHistory() if options.history else None
+		self.focus = options.focus
+		self.loop_summary = None
+		if options.loop_summary != None:
+			self.loop_summary = LoopSummary(options.loop_summary)
+		self.sampler = options.sampler
+		self.profile = options.profile
+		self.memory = options.memory
+
+		# Every thread the program starts is traced by its own copy of the
+		# logger (see new_thread_logger), which shares the frames, calls and
+		# clock, but has its own envs and loops. The envs of all threads are
+		# merged by time at the end of the run (see merge_threads).
+		self.main_thread_ident = threading.get_ident()
+		self.thread_ident = self.main_thread_ident
+		self.thread_loggers = []
+		self.loggers_by_thread = {}
+		# set on the loggers of threads that outlive the run
+		self.finished = False
+		# guards the history and loop summary, which all threads update
+		self.shared_lock = threading.Lock()
+		self.init_thread_state()
+
+	def init_thread_state(self):
 		self.data = {}
+		self.prev_env = None
+		# value of the memory counter at the end of the last event of the
+		# thread, None until the thread had one (see MemoryTrace)
+		self.memory_baseline = None
 		self.active_loops = []
-		self.preexisting_locals = None
 		self.exception = None
+		# frame of the last exception event, until the next line or return
+		# (see forget_frame)
+		self.raised_in = None
 		self.matplotlib_state_change = False
-
-		# Optional dict from (lineno, time) to a dict of varname: value
-		self.values = values
+		# ids of the frames whose last env was recorded because of its line
+		# (see should_record): their next env is recorded too, as it holds
+		# the values after that line
+		self.record_next = set()
+		# time of the last env of the thread, and of the env each loop
+		# marker follows, as markers have no time of their own
+		self.last_time = -1
+		self.marker_times = {}
+		# (lineno, function) the time of the program goes to in profile
+		# mode, and the time the program got back control from the tracer
+		self.profile_at = None
+		self.profile_mark = 0
+
+	def run(self, cmd):
+		if self.profile != None:
+			self.profile.calibrate()
+		if self.sampler != None:
+			self.run_sampled(cmd)
+			return
+		with self.traced_threads(self.trace_thread):
+			bdb.Bdb.run(self, cmd)
+
+	def run_sampled(self, cmd):
+		# like bdb.Bdb.run, but the trace function is only set during bursts
+		# (see start_burst). Only the main thread is sampled.
+		import __main__
+		if isinstance(cmd, str):
+			cmd = compile(cmd, "<string>", "exec")
+		self.reset()
+		self.botframe = sys._getframe()
+		# the first line traced is in the middle of the program, when its
+		# own globals are defined already
+		self.preexisting_locals = set(__main__.__dict__)
+		interval = self.sampler.interval
+		handler = signal.signal(signal.SIGPROF, self.start_burst)
+		signal.setitimer(signal.ITIMER_PROF, interval, interval)
+		try:
+			exec(cmd, __main__.__dict__)
+		except bdb.BdbQuit:
+			pass
+		finally:
+			signal.setitimer(signal.ITIMER_PROF, 0)
+			signal.signal(signal.SIGPROF, handler)
+			self.quitting = True
+			sys.settrace(None)
+
+	def start_burst(self, signum, frame):
+		if self.sampler.burst_end != None or self.clock.time >= 1000:
+			return
+		self.sampler.begin()
+		# frames that are already running only get line events once they
+		# have a local trace function
+		while frame != None:
+			if frame.f_code.co_filename == "<string>":
+				frame.f_trace = self.trace_dispatch
+			frame = frame.f_back
+		sys.settrace(self.trace_dispatch)
+
+	def burst_over(self):
+		# checked at every line and return in sampling mode. Once we recorded
+		# as many steps as a full trace would, the program goes on untraced.
+		if self.sampler == None or (self.sampler.burst_on() and self.clock.time < 1000):
+			return False
+		self.end_burst()
+		return True
+
+	def end_burst(self):
+		# the next burst starts afresh, so the loops of this one end here
+		while len(self.active_loops) > 0:
+			if self.loop_rows_sampled(self.active_loops[:-1]):
+				for l in self.stmts_in_loop(self.active_loops[-1].lineno):
+					self.data_at(l).append(self.create_end_loop_dummy_env())
+			del self.active_loops[-1]
+		self.prev_env = None
+		self.record_next = set()
+		for key in list(self.frame_ids):
+			self.drop_frame_id(key)
+		# the steps in between are not traced, so the first env of the
+		# next burst has no memory counts
+		self.memory_baseline = None
+		# a gap in time between bursts, so that the values after a line
+		# are never taken from another burst (see adjust_to_next_time_step)
+		self.clock.tick()
+		self.sampler.burst_end = None
+		sys.settrace(None)
+
+	def run_example(self, source, call):
+		# The functions of the program are defined already (see
+		# run_examples), so only the call runs, from code that is not traced
+		# as it is not the program's
+		self.run(compile(call, "<example>", "exec"))
+
+	@contextlib.contextmanager
+	def traced_threads(self, trace):
+		# trace gets the first event of every thread started by the program
+		excepthook = threading.excepthook
+		def quiet_excepthook(args):
+			# threads are stopped with BdbQuit like the main one, which is
+			# not an error of the program. This stays in place, as threads
+			# can outlive the run.
+			if not issubclass(args.exc_type, bdb.BdbQuit):
+				excepthook(args)
+		threading.excepthook = quiet_excepthook
+		threading.settrace(trace)
+		try:
+			yield
+		finally:
+			threading.settrace(None)
+			for logger in self.thread_loggers:
+				logger.finished = True
+
+	def trace_thread(self, frame, event, arg):
+		logger = self.new_thread_logger()
+		sys.settrace(logger.trace_dispatch)
+		return logger.trace_dispatch(frame, event, arg)
+
+	def new_thread_logger(self):
+		# thread idents are reused once a thread ends, so every new thread
+		# gets a new logger, and the ones of ended threads are kept
+		logger = object.__new__(type(self))
+		logger.__dict__.update(self.__dict__)
+		logger.thread_ident = threading.get_ident()
+		logger.init_thread_state()
+		self.thread_loggers.append(logger)
+		self.loggers_by_thread[logger.thread_ident] = logger
+		return logger
+
+	def thread_logger(self):
+		ident = threading.get_ident()
+		if ident == self.thread_ident:
+			return self
+		logger = self.loggers_by_thread.get(ident)
+		if logger == None:
+			logger = self.new_thread_logger()
+		return logger
+
+	def merge_threads(self):
+		# The envs of each thread are in time order at each line, and loop
+		# markers go right after the env they follow in their thread, so
+		# the merge is the same from one run to the next
+		if len(self.thread_loggers) == 0:
+			return
+		loggers = [self] + self.thread_loggers
+		data = {}
+		for lineno in set(l for logger in loggers for l in list(logger.data)):
+			streams = []
+			for (i, logger) in enumerate(loggers):
+				envs = list(logger.data.get(lineno, []))
+				streams.append([logger.env_order(env) + (i, j, env) for (j, env) in enumerate(envs)])
+			data[lineno] = [item[-1] for item in heapq.merge(*streams)]
+		self.data = data
+
+	def env_order(self, env):
+		if "time" in env:
+			return (env["time"], 0)
+		return (self.marker_times.get(id(env), -1), 1)
 
 	def data_at(self, l):
 		if not(l in self.data):
 			self.data[l] = []
 		return self.data[l]
 
+	def frame_id(self, frame):
+		fid = self.known_frame_id(frame)
+		if fid == None:
+			fid = next(self.frame_counter)
+			parent = self.caller_id(frame)
+			depth = 0 if parent == None else self.calls[parent].depth + 1
+			self.calls[fid] = CallInfo(parent, frame.f_code.co_name, depth)
+			self.frame_ids[id(frame)] = (frame.f_code, fid)
+		return fid
+
+	def known_frame_id(self, frame):
+		# the code is a cheap check against a stale entry
+		entry = self.frame_ids.get(id(frame))
+		if entry == None or entry[0] is not frame.f_code:
+			return None
+		return entry[1]
+
+	def caller_id(self, frame):
+		# the closest caller we have an id for, skipping library frames.
+		# After a sampling burst, callers that started before it get a
+		# new id here.
+		frame = frame.f_back
+		while frame != None:
+			fid = self.known_frame_id(frame)
+			if fid != None:
+				return fid
+			if self.sampler != None and self.is_traced_frame(frame):
+				return self.frame_id(frame)
+			frame = frame.f_back
+		return None
+
+	def forget_frame(self, frame, finished = False):
+		# Frames are dropped once they return. Generators and coroutines
+		# get a return event every time they are suspended, so they keep
+		# their id while they return at a yield, unless an exception goes
+		# through it (when they are closed or garbage collected there).
+		if not finished and frame.f_code.co_flags & SUSPENDABLE_CODE_FLAGS:
+			if frame.f_code.co_code[frame.f_lasti] == YIELD_VALUE and not self.raised_in is frame:
+				return
+		if self.known_frame_id(frame) != None:
+			self.drop_frame_id(id(frame))
+
+	def drop_frame_id(self, key):
+		(_, fid) = self.frame_ids.pop(key)
+		if self.history != None:
+			with self.shared_lock:
+				self.history.forget_frame(fid)
+		self.record_next.discard(fid)
+		if self.profile != None:
+			self.profile.frame_lines.pop(fid, None)
+
+	def dispatch_call(self, frame, arg):
+		# Frames of code that is not near the focus region run without
+		# a local trace function, so we don't get their line events
+		if self.focus != None and self.botframe != None and not self.focus.covers(frame.f_code):
+			self.user_call(frame, arg)
+			return None
+		return bdb.Bdb.dispatch_call(self, frame, arg)
+
+	def dispatch_line(self, frame):
+		# The top-level frame is set up by bdb itself, so this turns off
+		# tracing for it when needed
+		if self.focus != None and not self.focus.covers(frame.f_code):
+			return None
+		return bdb.Bdb.dispatch_line(self, frame)
+
 	def user_call(self, frame, args):
-		if not ("__name__" in frame.f_globals):
-			return
-		if frame.f_globals["__name__"] == "matplotlib.pyplot":
+		if self.profile != None:
+			self.profile_enter()
+		if "__name__" in frame.f_globals and frame.f_globals["__name__"] == "matplotlib.pyplot":
 			self.matplotlib_state_change = True
+		if self.profile != None:
+			self.profile_exit()
 
 	def user_line(self, frame):
 		# print("user_line ============================================")
@@ -87,71 +1043,115 @@ class Logger(bdb.Bdb):
 		# print("locals")
 		# print(frame.f_locals)
 
-		if frame.f_code.co_name == "<module>" and self.preexisting_locals == None:
-			self.preexisting_locals = set(frame.f_locals.keys())
+		if self.profile != None:
+			self.profile_enter()
+		self.raised_in = None
+		if self.is_traced_frame(frame):
+			self.record_line(frame, frame.f_lineno-1)
+		if self.profile != None:
+			self.profile_exit()
 
+	def is_traced_frame(self, frame):
 		if frame.f_code.co_name == "<listcomp>":
-			return
+			return False
 		if frame.f_code.co_name == "<dictcomp>":
-			return
+			return False
 		if frame.f_code.co_name == "<lambda>":
-			return
+			return False
 		if not ("__name__" in frame.f_globals):
-			return
+			return False
 		if frame.f_globals["__name__"] != "__main__":
-			return
+			return False
+		# run.py runs as __main__ too, and its signal handlers (see
+		# RunLimits) can run in the middle of the program
+		if frame.f_code.co_filename != "<string>":
+			return False
 		# When __qualname__ exists as a local, it means we are executing
 		# the method/field definitions inside a class, so we should
 		# not process these.
 		if "__qualname__" in frame.f_locals:
+			return False
+		return True
+
+	def record_line(self, frame, lineno):
+		if frame.f_code.co_name == "<module>" and self.preexisting_locals == None:
+			self.preexisting_locals = set(frame.f_locals.keys())
+		if self.stop_requested() or self.burst_over():
 			return
+		if self.profile != None:
+			self.profile_line(frame, lineno)
+			if not self.profile.capture:
+				return
 
 		self.exception = None
-		adjusted_lineno = frame.f_lineno-1
-		self.record_loop_end(frame, adjusted_lineno)
-		self.record_env(frame, adjusted_lineno)
-		self.record_loop_begin(frame, adjusted_lineno)
+		self.record_loop_end(frame, lineno)
+		self.record_env(frame, lineno)
+		self.record_loop_begin(frame, lineno)
+		self.step_done()
+
+	# The loop bookkeeping only needs to know where loops, breaks and
+	# returns are. The bdb backend finds them in the source text, with
+	# the following heuristics.
+
+	def is_loop_line(self, lineno):
+		return is_loop_str(self.lines[lineno])
+
+	def is_break_line(self, lineno):
+		return is_break_str(self.lines[lineno])
+
+	def is_return_line(self, lineno):
+		return is_return_str(self.lines[lineno])
+
+	def is_after_loop(self, loop, lineno):
+		return indent(self.lines[lineno]) <= loop.indent and lineno != loop.lineno
+
+	def stop_requested(self):
+		# line and return events are where a run can stop cleanly
+		if self.finished or self.limits.should_stop():
+			self.set_quit()
+			return True
+		return False
 
 	def record_loop_end(self, frame, lineno):
-		curr_stmt = self.lines[lineno]
-		if self.prev_env != None and len(self.active_loops) > 0 and self.active_loops[-1].frame is frame:
+		if self.prev_env != None and len(self.active_loops) > 0 and self.active_loops[-1].frame == self.frame_id(frame):
 			prev_lineno = remove_R(self.prev_env["lineno"])
-			prev_stmt = self.lines[prev_lineno]
-
-			loop_indent = self.active_loops[-1].indent
-			curr_indent = indent(curr_stmt)
 			curr_frame_name = frame.f_code.co_name
-			prev_frame_name = self.prev_env["frame"].f_code.co_name
-			if is_return_str(prev_stmt) and curr_frame_name == prev_frame_name:
+			prev_frame_name = self.calls[self.prev_env["frame"]].name
+			if self.is_return_line(prev_lineno) and curr_frame_name == prev_frame_name:
 				# we shouldn't record the end of a loop after
 				# a call to another function with a return statement,
 				# so we need to check whether prev stmt comes from the same frame
 				# as the current one
 				while len(self.active_loops) > 0:
 					self.active_loops[-1].iter += 1
-					for l in self.stmts_in_loop(self.active_loops[-1].lineno):
-						self.data_at(l).append(self.create_end_loop_dummy_env())
+					if self.loop_rows_sampled(self.active_loops[:-1]):
+						for l in self.stmts_in_loop(self.active_loops[-1].lineno):
+							self.data_at(l).append(self.create_end_loop_dummy_env())
 					del self.active_loops[-1]
-			elif (curr_indent <= loop_indent and lineno != self.active_loops[-1].lineno):
+			elif self.is_after_loop(self.active_loops[-1], lineno):
 				# break statements don't go through the loop header, so we miss
 				# the last increment in iter, which is why we have to adjust here
-				if is_break_str(prev_stmt):
+				if self.is_break_line(prev_lineno):
 					self.active_loops[-1].iter += 1
-				for l in self.stmts_in_loop(self.active_loops[-1].lineno):
-					self.data_at(l).append(self.create_end_loop_dummy_env())
+				if self.loop_rows_sampled(self.active_loops[:-1]):
+					for l in self.stmts_in_loop(self.active_loops[-1].lineno):
+						self.data_at(l).append(self.create_end_loop_dummy_env())
 				del self.active_loops[-1]
 
 	def record_loop_begin(self, frame, lineno):
 		# for l in self.active_loops:
 		#	 print("Active loop at line " + str(l.lineno) + ", iter " + str(l.iter))
-		curr_stmt = self.lines[lineno]
-		if is_loop_str(curr_stmt):
+		if self.is_loop_line(lineno):
 			if len(self.active_loops) > 0 and self.active_loops[-1].lineno == lineno:
 				self.active_loops[-1].iter += 1
 			else:
-				self.active_loops.append(LoopInfo(frame, lineno, indent(curr_stmt)))
-				for l in self.stmts_in_loop(lineno):
-					self.data_at(l).append(self.create_begin_loop_dummy_env())
+				self.active_loops.append(LoopInfo(self.frame_id(frame), lineno, indent(self.lines[lineno])))
+				if self.loop_rows_sampled(self.active_loops[:-1]):
+					for l in self.stmts_in_loop(lineno):
+						self.data_at(l).append(self.create_begin_loop_dummy_env())
+
+	def loop_rows_sampled(self, loops):
+		return self.loop_summary == None or self.loop_summary.sampled(loops)
 
 	def stmts_in_loop(self, lineno):
 		result = []
@@ -178,12 +1178,16 @@ class Logger(bdb.Bdb):
 
 	def create_begin_loop_dummy_env(self):
 		env = {"begin_loop":self.active_loops_iter_str()}
+		env["frame"] = self.active_loops[-1].frame
 		self.add_loop_info(env)
+		self.marker_times[id(env)] = self.last_time
 		return env
 
 	def create_end_loop_dummy_env(self):
 		env = {"end_loop":self.active_loops_iter_str()}
+		env["frame"] = self.active_loops[-1].frame
 		self.add_loop_info(env)
+		self.marker_times[id(env)] = self.last_time
 		return env
 
 	def compute_repr(self, v):
@@ -193,8 +1197,23 @@ class Logger(bdb.Bdb):
 			return None
 		if isinstance(v, type):
 			return None
+		if self.stats == None:
+			return self.compute_repr_str(v)
+		self.stats.repr_calls += 1
+		start = perf_counter()
+		r = self.compute_repr_str(v)
+		self.stats.add_time("image" if r.startswith("```html") else "repr", perf_counter() - start)
+		return r
+
+	def compute_repr_str(self, v):
 		html = if_img_convert_to_html(v)
 		if html == None:
+			try:
+				summary = summarize_value(v)
+				if summary != None:
+					return summary
+			except:
+				pass
 			try:
 				return repr(v)
 			except:
@@ -203,37 +1222,65 @@ class Logger(bdb.Bdb):
 			return add_html_escape(html)
 
 	def record_env(self, frame, lineno):
-		line_time = "(%s,%d)" % (lineno, self.time)
-		if line_time in self.values:
-			# Replace the current values with the given ones first
-			print('%s:' % line_time)
-			env = self.values[line_time]
-			print(frame.f_locals)
-
-			for varname in frame.f_locals:
-				if varname in env:
-					new_value = eval(env[varname])
-					print("\t'%s': '%s' -> '%s'" % (varname, repr(frame.f_locals[varname]), repr(new_value)))
-					frame.f_locals.update({ varname: new_value })
-					ctypes.pythonapi.PyFrame_LocalsToFast(ctypes.py_object(frame), ctypes.c_int(0))
-
-		if self.time >= 1000:
+		if self.scenarios != None and self.scenarios.at_checkpoint(self.clock.time, lineno):
+			self.injections = self.scenarios.fork()
+		injection = self.injections.get(self.clock.time)
+		if injection != None and injection[0] == str(lineno):
+			self.inject_values(frame, injection[1], injection[2])
+
+		if self.clock.steps() >= 1000:
+			self.clock.limit_reached = True
 			self.set_quit()
 			return
+		if not self.should_record(frame, lineno):
+			# we only need the frame and line of envs that are not
+			# recorded, for the loop bookkeeping
+			self.prev_env = {"frame": self.frame_id(frame), "lineno": lineno}
+			if self.history != None:
+				with self.shared_lock:
+					self.history.ran(self.prev_env["frame"], lineno)
+			if self.loop_summary != None and (self.focus == None or self.focus.has_line(lineno)):
+				# only the steps left out by the loop summary count towards
+				# the limit, lines out of focus don't
+				self.clock.skip()
+				self.summarize_env(frame)
+			return
+		memory = None
+		if self.memory != None and self.memory_baseline != None:
+			# read first, as everything below allocates
+			memory = self.memory.since(self.memory_baseline)
 		env = {}
-		env["frame"] = frame
-		env["time"] = self.time
+		env["frame"] = self.frame_id(frame)
+		env["time"] = self.clock.tick()
+		self.last_time = env["time"]
 		self.add_loop_info(env)
-		self.time = self.time + 1
-		for k in frame.f_locals:
-			if k != magic_var_name and (frame.f_code.co_name != "<module>" or not k in self.preexisting_locals):
-				r = self.compute_repr(frame.f_locals[k])
-				if (r != None):
-					env[k] = r
+		if self.sampler != None:
+			env["sampled"] = self.sampler.bursts
+		if self.stats != None:
+			self.stats.events += 1
+		for (k, r) in self.local_reprs(frame):
+			env[k] = r
+			if self.stats != None:
+				self.stats.add_repr(k, r)
+			if self.history != None:
+				with self.shared_lock:
+					self.history.record(env["time"], lineno, env["frame"], k, r)
+		if self.history != None:
+			with self.shared_lock:
+				self.history.ran(env["frame"], lineno)
+		if self.loop_summary != None:
+			self.summarize_env(frame, env)
+		if memory != None:
+			env["Net alloc"] = str(memory[0])
+			env["Peak alloc"] = str(memory[1])
 		env["lineno"] = lineno
 
 		if self.matplotlib_state_change:
-			env["Plot"] = add_html_escape(matplotlib_fig_as_html())
+			if self.stats == None:
+				env["Plot"] = add_html_escape(matplotlib_fig_as_html())
+			else:
+				with self.stats.phase("image"):
+					env["Plot"] = add_html_escape(matplotlib_fig_as_html())
 			self.matplotlib_state_change = False
 
 			if self.prev_env != None:
@@ -249,11 +1296,85 @@ class Logger(bdb.Bdb):
 			env["prev_lineno"] = self.prev_env["lineno"]
 
 		self.prev_env = env
+		return env
+
+	def inject_values(self, frame, line_time, env):
+		# Replace the current values with the given ones first
+		print('%s:' % line_time)
+		print(frame.f_locals)
+
+		for varname in frame.f_locals:
+			if varname in env:
+				new_value = eval(env[varname], frame.f_globals, frame.f_locals)
+				print("\t'%s': '%s' -> '%s'" % (varname, repr(frame.f_locals[varname]), repr(new_value)))
+				frame.f_locals.update({ varname: new_value })
+				ctypes.pythonapi.PyFrame_LocalsToFast(ctypes.py_object(frame), ctypes.c_int(0))
+
+	def local_reprs(self, frame):
+		for k in frame.f_locals:
+			if k != magic_var_name and (frame.f_code.co_name != "<module>" or not k in self.preexisting_locals):
+				r = self.compute_repr(frame.f_locals[k])
+				if (r != None):
+					yield (k, r)
+
+	def should_record(self, frame, lineno):
+		# Envs are recorded for lines in the focus region, in sampled
+		# loop iterations, and right after those
+		if self.focus == None and self.loop_summary == None:
+			return True
+		fid = self.frame_id(frame)
+		after_recorded = fid in self.record_next
+		if (self.focus == None or self.focus.has_line(lineno)) and self.loop_rows_sampled(self.active_loops):
+			self.record_next.add(fid)
+			return True
+		self.record_next.discard(fid)
+		return after_recorded
+
+	def summarize_env(self, frame, reprs = None):
+		# adds the variables of the frame to the summary of its innermost
+		# loop. Steps that are not recorded have no reprs, see summary_inputs.
+		fid = self.frame_id(frame)
+		for loop in reversed(self.active_loops):
+			if loop.frame == fid:
+				with self.shared_lock:
+					if reprs == None:
+						inputs = self.summary_inputs(frame)
+					else:
+						inputs = ((k, frame.f_locals[k], reprs[k]) for k in frame.f_locals if k in reprs)
+					for (k, v, r) in inputs:
+						self.loop_summary.add(loop, k, v, r)
+				return
+
+	def summary_inputs(self, frame):
+		# (name, value, repr) of the variables of a step that is not
+		# recorded. Only the values that print cheaply get a repr, the
+		# others only count towards the count, min, max and types.
+		for (k, v) in frame.f_locals.items():
+			if k == magic_var_name or (frame.f_code.co_name == "<module>" and k in self.preexisting_locals):
+				continue
+			if isinstance(v, (types.FunctionType, types.ModuleType, type)):
+				continue
+			r = None
+			# not v == None, which runs the __eq__ of the value
+			if type(v) in (type(None), bool, int, float) or (type(v) == str and len(v) <= SUMMARY_MIN_SIZE):
+				r = repr(v)
+			yield (k, v, r)
 
 	def user_exception(self, frame, e):
 		self.exception = e[1]
+		self.raised_in = frame
 
 	def user_return(self, frame, rv):
+		if self.profile != None:
+			self.profile_enter()
+		if self.is_traced_frame(frame):
+			self.record_return(frame, rv, frame.f_lineno-1)
+		self.forget_frame(frame)
+		self.raised_in = None
+		if self.profile != None:
+			self.profile_exit()
+
+	def record_return(self, frame, rv, adjusted_lineno):
 		# print("user_return ============================================")
 		# print(frame.f_code.co_name)
 		# print("lineno")
@@ -264,22 +1385,14 @@ class Logger(bdb.Bdb):
 		# print("locals")
 		# print(frame.f_locals)
 
-		if frame.f_code.co_name == "<listcomp>":
-			return
-		if frame.f_code.co_name == "<dictcomp>":
-			return
-		if frame.f_code.co_name == "<lambda>":
-			return
-		if not ("__name__" in frame.f_globals):
-			return
-		if frame.f_globals["__name__"] != "__main__":
-			return
-		if "__qualname__" in frame.f_locals:
+		if self.stop_requested() or self.burst_over():
 			return
-
-		adjusted_lineno = frame.f_lineno-1
-
-		self.record_env(frame, "R" + str(adjusted_lineno))
+		if self.profile != None:
+			# the time after a return goes to the line of the caller
+			self.profile_at = self.profile.frame_lines.get(self.caller_id(frame))
+			if not self.profile.capture:
+				return
+		env = self.record_env(frame, "R" + str(adjusted_lineno))
 		if self.exception == None:
 			r = self.compute_repr(rv)
 			rv_name = "rv"
@@ -287,9 +1400,39 @@ class Logger(bdb.Bdb):
 			html = add_red_format(self.exception.__class__ .__name__ + ": " + str(self.exception))
 			r = add_html_escape(html)
 			rv_name = "Exception Thrown"
-		if r != None and (frame.f_code.co_name != "<module>" or self.exception != None):
-			self.data_at("R" + str(adjusted_lineno))[-1][rv_name] = r
+		if env != None and r != None and (frame.f_code.co_name != "<module>" or self.exception != None):
+			env[rv_name] = r
+			if self.stats != None:
+				self.stats.add_repr(rv_name, r)
 		self.record_loop_end(frame, adjusted_lineno)
+		self.step_done()
+
+	def step_done(self):
+		# every step of the program resets the memory counters, whether
+		# its env is recorded or not, so that each env only counts the
+		# step before it
+		if self.memory != None:
+			self.memory_baseline = self.memory.reset()
+
+	# In profile mode, the time between the end of an event and the start
+	# of the next one is the time of the program, minus what bdb takes to
+	# get from one to the other (see LineProfile.calibrate). The time of the
+	# tracer itself, including the capture of values, is left out.
+
+	def profile_enter(self):
+		now = perf_counter_ns()
+		if self.profile_at != None:
+			with self.shared_lock:
+				self.profile.add_time(self.profile_at, now - self.profile_mark)
+
+	def profile_exit(self):
+		self.profile_mark = perf_counter_ns()
+
+	def profile_line(self, frame, lineno):
+		function = frame.f_code.co_qualname
+		with self.shared_lock:
+			self.profile.line(self.frame_id(frame), lineno, function)
+		self.profile_at = (lineno, function)
 
 	def pretty_print_data(self):
 		for k in self.data:
@@ -297,6 +1440,242 @@ class Logger(bdb.Bdb):
 			for env in self.data[k]:
 				print(env)
 
+class InstrumentedLogger(Logger):
+	# Traces the program by rewriting its AST to call hooks at the places
+	# where bdb would get line and return events (see instrument.py), so
+	# that there is no trace function running on every line, in every frame.
+	# The bookkeeping is the one of Logger, but loops, breaks and returns
+	# come from the structure of the program instead of its text.
+	def __init__(self, lines, writes, values = [], options = None):
+		Logger.__init__(self, lines, writes, values, options)
+		self.structure = None
+		self.tracing = False
+		# last line and pending return value of the frames being traced
+		self.last_lines = {}
+		self.return_values = {}
+		self.pyplot_functions = None
+
+	def init_thread_state(self):
+		Logger.init_thread_state(self)
+		# set while a hook runs, so that code it calls (e.g. __repr__
+		# methods of user classes) is not traced
+		self.in_hook = False
+		self.class_prologue = False
+
+	def run(self, cmd):
+		self.run_code(self.instrument(cmd))
+
+	def run_example(self, source, call):
+		# the functions were instrumented by the run of the program, so
+		# only the structure is needed here
+		self.instrument(source)
+		self.run_code(compile(call, "<example>", "exec"))
+
+	def instrument(self, source):
+		import instrument
+		self.structure = instrument.Instrumenter()
+		root = self.structure.instrument(ast.parse(source))
+		return compile(root, "<string>", "exec")
+
+	def run_code(self, code):
+		import __main__
+		import instrument
+		globals = __main__.__dict__
+		globals.update({
+			instrument.LINE_HOOK: self.line_hook,
+			instrument.ITER_HOOK: self.iter_hook,
+			instrument.CLASS_HOOK: self.class_hook,
+			instrument.DECORATE_HOOK: self.decorate_hook,
+			instrument.RETURN_HOOK: self.return_hook,
+			instrument.YIELD_HOOK: self.yield_hook,
+			instrument.UNWIND_HOOK: self.unwind_hook,
+			instrument.EXIT_HOOK: self.exit_hook,
+		})
+		self.reset()
+		self.patch_pyplot()
+		self.tracing = True
+		try:
+			with self.traced_threads(self.start_thread):
+				exec(code, globals)
+		except bdb.BdbQuit:
+			pass
+		finally:
+			self.quitting = True
+			self.tracing = False
+			self.unpatch_pyplot()
+
+	def start_thread(self, frame, event, arg):
+		# the hooks find the logger of their thread, which only has to be
+		# made when the thread starts, without tracing it
+		sys.settrace(None)
+		self.new_thread_logger()
+		return None
+
+	def is_loop_line(self, lineno):
+		return lineno in self.structure.loops
+
+	def is_break_line(self, lineno):
+		return lineno in self.structure.breaks
+
+	def is_return_line(self, lineno):
+		return lineno in self.structure.returns
+
+	def is_after_loop(self, loop, lineno):
+		(first, last) = self.structure.loops[loop.lineno]
+		return lineno != loop.lineno and (lineno < first or lineno > last)
+
+	def stmts_in_loop(self, lineno):
+		(first, last) = self.structure.loops[lineno]
+		return [l for l in range(first, last+1) if self.lines[l].strip() != ""]
+
+	def local_reprs(self, frame):
+		# the names python binds at the start of a class body are not
+		# there yet when bdb gets the first event of the class
+		if self.class_prologue:
+			return iter(())
+		return Logger.local_reprs(self, frame)
+
+	def hooked_frame(self, frame):
+		if not self.tracing or self.in_hook:
+			return False
+		if self.focus != None and not self.focus.covers(frame.f_code):
+			return False
+		return True
+
+	# The hooks are methods of the logger of the main thread, so they
+	# first switch to the logger of the thread they run in.
+
+	def line_event(self, frame, lineno):
+		self = self.thread_logger()
+		if self.quitting and self.tracing:
+			raise bdb.BdbQuit
+		if not self.hooked_frame(frame):
+			return
+		self.in_hook = True
+		try:
+			if self.pyplot_functions == None and self.thread_ident == self.main_thread_ident:
+				self.patch_pyplot()
+			self.last_lines[self.frame_id(frame)] = lineno
+			self.record_line(frame, lineno)
+		finally:
+			self.in_hook = False
+		if self.quitting:
+			raise bdb.BdbQuit
+
+	def line_hook(self, lineno):
+		self.line_event(sys._getframe(1), lineno)
+
+	def iter_hook(self, lineno, iterable):
+		# the loop header gets an event before every fetch but the first,
+		# which is the one of the for statement itself
+		for x in iterable:
+			yield x
+			self.line_event(sys._getframe(1), lineno)
+
+	def class_hook(self, lineno):
+		# class bodies have no other event, so this is also where their
+		# frame ends for us
+		self = self.thread_logger()
+		frame = sys._getframe(1)
+		self.class_prologue = True
+		try:
+			self.line_event(frame, lineno)
+		finally:
+			self.class_prologue = False
+		fid = self.known_frame_id(frame)
+		if fid != None:
+			self.last_lines.pop(fid, None)
+			self.forget_frame(frame, True)
+
+	def decorate_hook(self, lineno, def_lineno, innermost, outermost, decorator):
+		def decorate(f):
+			frame = sys._getframe(1)
+			if innermost:
+				self.line_event(frame, def_lineno)
+			self.line_event(frame, lineno)
+			result = decorator(f)
+			if outermost:
+				self.line_event(frame, def_lineno)
+			return result
+		return decorate
+
+	def return_hook(self, rv):
+		self = self.thread_logger()
+		frame = sys._getframe(1)
+		if self.hooked_frame(frame):
+			self.return_values[self.frame_id(frame)] = rv
+		return rv
+
+	def yield_hook(self, v):
+		self = self.thread_logger()
+		frame = sys._getframe(1)
+		if self.hooked_frame(frame) and not self.quitting:
+			self.in_hook = True
+			try:
+				self.record_return(frame, v, self.last_lines.get(self.frame_id(frame), frame.f_lineno-1))
+			finally:
+				self.in_hook = False
+		return v
+
+	def unwind_hook(self):
+		self = self.thread_logger()
+		if self.hooked_frame(sys._getframe(1)) and not self.quitting:
+			self.exception = sys.exc_info()[1]
+
+	def exit_hook(self):
+		self = self.thread_logger()
+		frame = sys._getframe(1)
+		if not self.hooked_frame(frame) or self.quitting:
+			return
+		self.in_hook = True
+		try:
+			fid = self.frame_id(frame)
+			lineno = self.last_lines.pop(fid, frame.f_lineno-1)
+			self.record_return(frame, self.return_values.pop(fid, None), lineno)
+			self.forget_frame(frame, True)
+		finally:
+			self.in_hook = False
+
+	def patch_pyplot(self):
+		# bdb notices calls into pyplot through their call events, here
+		# we wrap the functions of the module instead
+		pyplot = sys.modules.get("matplotlib.pyplot")
+		if pyplot == None:
+			return
+		self.pyplot_functions = {}
+		for (name, f) in list(vars(pyplot).items()):
+			if isinstance(f, types.FunctionType) and f.__module__ == pyplot.__name__:
+				self.pyplot_functions[name] = f
+				setattr(pyplot, name, self.pyplot_wrapper(f))
+
+	def pyplot_wrapper(self, f):
+		def wrapper(*args, **kwargs):
+			logger = self.thread_logger()
+			if not logger.in_hook:
+				logger.matplotlib_state_change = True
+			return f(*args, **kwargs)
+		wrapper.__wrapped__ = f
+		return wrapper
+
+	def unpatch_pyplot(self):
+		if self.pyplot_functions == None:
+			return
+		pyplot = sys.modules["matplotlib.pyplot"]
+		for (name, f) in self.pyplot_functions.items():
+			setattr(pyplot, name, f)
+		self.pyplot_functions = None
+
+
+class OverheadProbe(Logger):
+	# Times the line events of a loop that does nothing, through the same
+	# dispatch as the Logger: what is left between two of them is the time
+	# the tracer takes to get from a line to the next user_line.
+	def __init__(self):
+		Logger.__init__(self, [], {})
+		self.times = []
+
+	def user_line(self, frame):
+		self.times.append(perf_counter_ns())
 
 class WriteCollector(ast.NodeVisitor):
 	def __init__(self):
@@ -365,20 +1744,169 @@ def compute_writes(lines):
 		writes = write_collector.data
 	return (writes, exception)
 
-def compute_runtime_data(lines, writes, values):
+# Modules that core.py used to import up front. Values only import them
+# when needed now, but when the program itself imports them, they are loaded
+# before tracing starts, as loading them under the tracer is much slower.
+PRELOADED_MODULES = {"numpy": "numpy", "PIL": "PIL.Image", "matplotlib": "matplotlib.pyplot"}
+
+def preload_modules(root):
+	for node in ast.walk(root):
+		if isinstance(node, ast.Name) and isinstance(globals().get(node.id), LazyModule):
+			# np, plt or Image, without an import (see LazyModule)
+			try:
+				globals()[node.id].load()
+			except ImportError:
+				pass
+			continue
+		if isinstance(node, ast.Import):
+			names = [alias.name for alias in node.names]
+		elif isinstance(node, ast.ImportFrom) and node.level == 0:
+			names = [node.module]
+		else:
+			continue
+		for name in names:
+			module = PRELOADED_MODULES.get(name.split(".")[0])
+			if module != None and not module in sys.modules:
+				try:
+					__import__(module)
+				except ImportError:
+					pass
+
+def compute_runtime_data(lines, writes, values, options = None, sections = None, example = None):
+	# Optional output sections computed from the trace are added to the
+	# sections dict. When example (a call expression) is given, only that
+	# call is traced, in a process where the program already ran (see
+	# run_examples).
+	if options == None:
+		options = RunOptions()
+	if sections == None:
+		sections = {}
 	exception = None
 	if len(lines) == 0:
 		return ({}, exception)
 	code = "".join(lines)
-	l = Logger(lines, writes, values)
-	try:
-		l.run(code)
-	except Exception as e:
-		exception = e
-	l.data = adjust_to_next_time_step(l.data, l.lines)
-	remove_frame_data(l.data)
+	root = ast.parse(code)
+	if options.focus != None:
+		options.focus.resolve(root)
+	stats = options.stats
+	if example == None:
+		with phase(stats, "import"):
+			preload_modules(root)
+		if startup.timer != None:
+			sections["startup"] = startup.timer.report()
+	# the hooks of instrumented code can't be turned off between samples,
+	# and the line profile times the events of bdb
+	if options.backend == "ast" and options.sampler == None and options.profile == None:
+		l = InstrumentedLogger(lines, writes, values, options)
+	else:
+		l = Logger(lines, writes, values, options)
+	limits = options.limits
+	with phase(stats, "trace"):
+		limits.start()
+		if options.memory != None:
+			options.memory.start()
+			l.step_done()
+		try:
+			if example == None:
+				l.run(code)
+			else:
+				l.run_example(code, example)
+		except RunStopped:
+			pass
+		except Exception as e:
+			if not limits.stopped_by(e):
+				exception = e
+		finally:
+			limits.stop()
+			if options.memory != None:
+				options.memory.stop()
+	with phase(stats, "adjust"):
+		l.merge_threads()
+		l.data = adjust_to_next_time_step(l.data, l.lines)
+		if options.focus != None:
+			l.data = {lineno: envs for (lineno, envs) in l.data.items() if options.focus.has_line(lineno)}
+		if options.call_depth != None:
+			(l.data, deferred) = split_by_call(l.data, l.calls, options.call_depth)
+			sections["calls"] = {str(fid): call.to_json() for fid, call in l.calls.items()}
+			sections["deferred_calls"] = deferred
+		if l.history != None:
+			sections["history"] = l.history.to_json()
+		if l.loop_summary != None:
+			sections["loop_summary"] = l.loop_summary.to_json()
+		if l.profile != None:
+			sections["profile"] = l.profile.to_json()
+		remove_frame_data(l.data)
+	if limits.stop_reason != None:
+		sections["stopped"] = limits.stop_reason
+	elif l.clock.limit_reached:
+		# the steps limit is part of every run, so it is not reported as
+		# "stopped" (which changes the return code), only noted
+		sections["step_limit"] = 1000
 	return (l.data, exception)
 
+# lines, writes and options of the run, for the example workers, which get
+# them when they are forked
+example_run = None
+
+def run_examples(lines, writes, options, sections):
+	# Traces every example in a worker of a process pool, and adds an
+	# "examples" section with the result of each. The workers are forked
+	# once the program ran, so they all start from the state it ended in,
+	# with its functions defined, without running or parsing it again.
+	global example_run
+	import multiprocessing
+	ids = list(options.examples)
+	if len(ids) == 0:
+		return
+	workers = options.example_workers
+	if workers == None:
+		workers = min(len(ids), os.cpu_count() or 1)
+	example_run = (lines, writes, options)
+	sys.stdout.flush()
+	sys.stderr.flush()
+	def cancel(signum, frame):
+		raise RunStopped()
+	with multiprocessing.get_context("fork").Pool(workers) as pool:
+		# set once the workers are forked, which keep the default handlers
+		handlers = {signum: signal.signal(signum, cancel) for signum in [signal.SIGTERM, signal.SIGINT]}
+		try:
+			sections["examples"] = dict(zip(ids, pool.map(trace_example, ids)))
+		except RunStopped:
+			# workers may be in a call that signals can't interrupt
+			for worker in multiprocessing.active_children():
+				worker.kill()
+			sections["stopped"] = "cancelled"
+		finally:
+			for (signum, handler) in handlers.items():
+				signal.signal(signum, handler)
+
+def trace_example(id):
+	(lines, writes, options) = example_run
+	example = options.examples[id]
+	call = "%s(%s)" % (example["function"], ", ".join(example.get("args", [])))
+	# every example gets the limits of the whole run
+	example_options = RunOptions(
+		history = options.history,
+		focus = options.focus,
+		loop_summary = options.loop_summary,
+		backend = options.backend,
+		limits = RunLimits.from_environ())
+	sections = {}
+	(run_time_data, exception) = compute_runtime_data(lines, writes, {}, example_options, sections, call)
+	result = {"return_code": 0, "run_time_data": run_time_data}
+	if exception != None:
+		result["return_code"] = 2
+		result["exception"] = "".join(traceback.format_exception_only(exception)).strip()
+	elif "stopped" in sections:
+		result["return_code"] = STOPPED_RETURN_CODE
+	result.update(sections)
+	return result
+
+def phase(stats, name):
+	if stats == None:
+		return contextlib.nullcontext()
+	return stats.phase(name)
+
 def adjust_to_next_time_step(data, lines):
 	envs_by_time = {}
 	for lineno in data:
@@ -397,8 +1925,8 @@ def adjust_to_next_time_step(data, lines):
 				next_time = env["time"]+1
 				while next_time in envs_by_time:
 					next_env = envs_by_time[next_time]
-					if "frame" in env and "frame" in next_env and env["frame"] is next_env["frame"]:
-						curr_stmt = lines[env["lineno"]]
+					if "frame" in env and "frame" in next_env and env["frame"] == next_env["frame"]:
+						curr_stmt = lines[remove_R(env["lineno"])]
 						next_stmt = lines[remove_R(next_env["lineno"])]
 						if "Exception Thrown" in next_env or not is_loop_str(curr_stmt) or indent(next_stmt) > indent(curr_stmt):
 							next_envs.append(next_env)
@@ -410,43 +1938,210 @@ def adjust_to_next_time_step(data, lines):
 		new_data[lineno] = next_envs
 	return new_data
 
+def split_by_call(data, calls, max_depth):
+	# Tags every env with the id of its call, and moves the envs of calls
+	# deeper than max_depth out of data, into a separate dict from call id
+	# to the {lineno: envs} of that call.
+	kept = {}
+	deferred = {}
+	for lineno in data:
+		kept[lineno] = []
+		for env in data[lineno]:
+			if not "frame" in env:
+				kept[lineno].append(env)
+				continue
+			fid = env["frame"]
+			env["call"] = fid
+			if calls[fid].depth <= max_depth:
+				kept[lineno].append(env)
+			else:
+				if not fid in deferred:
+					deferred[fid] = {}
+				call_data = deferred[fid]
+				if not lineno in call_data:
+					call_data[lineno] = []
+				call_data[lineno].append(env)
+	for call_data in deferred.values():
+		remove_frame_data(call_data)
+	return (kept, deferred)
+
+def write_call_slices(file, sections):
+	# Writes one json line per deferred call to <file>.calls, and records
+	# the [offset, length] of that line in the call's entry in sections["calls"],
+	# so the editor can read a single call without parsing the others.
+	deferred = sections.pop("deferred_calls")
+	offset = 0
+	with output_file(file + ".calls", "wb") as out:
+		for fid, call_data in deferred.items():
+			line = (json.dumps(call_data) + "\n").encode()
+			out.write(line)
+			sections["calls"][str(fid)]["slice"] = [offset, len(line)]
+			offset += len(line)
+
 def remove_frame_data(data):
 	for lineno in data:
 		for env in data[lineno]:
 			if "frame" in env:
 				del env["frame"]
 
+def diff_run_time_data(file, run_time_data, base, sections):
+	# Serializes run_time_data with only the lines whose envs changed since
+	# the run with id base. The fingerprints of the lines of the last run are
+	# kept in <file>.fingerprints. When they are not the ones of run base
+	# (e.g. the editor dropped the output of that run), all lines are sent.
+	serialized = {str(lineno): json.dumps(envs) for (lineno, envs) in run_time_data.items()}
+	fingerprints = {lineno: hashlib.sha1(s.encode()).hexdigest() for (lineno, s) in serialized.items()}
+	run = hashlib.sha1(json.dumps(fingerprints, sort_keys = True).encode()).hexdigest()
+	previous = None
+	try:
+		with open(file + ".fingerprints") as f:
+			previous = json.load(f)
+	except (OSError, ValueError):
+		pass
+	with output_file(file + ".fingerprints") as out:
+		json.dump({"run": run, "lines": fingerprints}, out)
+
+	diff = {"run": run, "base": None}
+	sent = serialized
+	if previous != None and previous["run"] == base:
+		old = previous["lines"]
+		diff["base"] = base
+		diff["unchanged"] = [l for l in fingerprints if l in old and old[l] == fingerprints[l]]
+		diff["changed"] = [l for l in fingerprints if l in old and old[l] != fingerprints[l]]
+		diff["added"] = [l for l in fingerprints if not l in old]
+		diff["removed"] = [l for l in old if not l in fingerprints]
+		sent = {l: serialized[l] for l in diff["changed"] + diff["added"]}
+	sections["diff"] = diff
+	return "{" + ", ".join(json.dumps(l) + ": " + s for (l, s) in sent.items()) + "}"
+
+@contextlib.contextmanager
+def output_file(path, mode = "w"):
+	# Output files are written to a temporary file, and replaced in one
+	# step, so that the editor never reads one that a run is still writing
+	tmp = "%s.%d.tmp" % (path, os.getpid())
+	try:
+		with open(tmp, mode) as out:
+			yield out
+		os.replace(tmp, path)
+	finally:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+
 def main(file, values_file = None):
-	lines = load_code_lines(file)
+	options = RunOptions.from_environ()
+	stats = options.stats
+	sections = {}
+
+	with phase(stats, "preprocess"):
+		lines = load_code_lines(file)
 	values = []
 
 	if values_file:
 		values = json.load(open(values_file))
+		if isinstance(values, list):
+			options.scenarios = Scenarios(values)
+			values = {}
 
 	return_code = 0
 	run_time_data = {}
 
-	(writes, exception) = compute_writes(lines)
+	with phase(stats, "parse"):
+		(writes, exception) = compute_writes(lines)
 
 	if exception != None:
 		return_code = 1
 	else:
-		(run_time_data, exception) = compute_runtime_data(lines, writes, values)
+		(run_time_data, exception) = compute_runtime_data(lines, writes, values, options, sections)
+		if options.examples != None and not "stopped" in sections:
+			with phase(stats, "examples"):
+				run_examples(lines, writes, options, sections)
 		if (exception != None):
 			return_code = 2
-
-	with open(file + ".out", "w") as out:
-		out.write(json.dumps((return_code, writes, run_time_data)))
-
+		elif "stopped" in sections:
+			return_code = STOPPED_RETURN_CODE
+			print("Run stopped: " + sections["stopped"], file = sys.stderr)
+	if "startup" in sections and sections["startup"]["over_budget"]:
+		print(startup.describe(sections["startup"]), file = sys.stderr)
+
+	scenarios = options.scenarios
+	if sections.get("stopped") == "cancelled":
+		# The editor drops the result of a run it cancelled, and may have
+		# started the next one on the same files already, so a cancelled
+		# run writes nothing
+		if scenarios != None and scenarios.index == 0:
+			scenarios.cancel()
+		if scenarios != None and scenarios.index > 0:
+			sys.stderr.flush()
+			os._exit(0)
+		return
+	out_file = file
+	if scenarios != None:
+		out_file = scenarios.output_base(file)
+		sections["scenario"] = scenarios.index
+	with phase(stats, "serialize"):
+		if options.diff != None:
+			result = "[%d, %s, %s]" % (return_code, json.dumps(writes), diff_run_time_data(out_file, run_time_data, options.diff, sections))
+		else:
+			result = json.dumps((return_code, writes, run_time_data))
+		if "deferred_calls" in sections:
+			write_call_slices(out_file, sections)
+	if options.trace_store:
+		import trace_store
+		with phase(stats, "store"):
+			with output_file(out_file + ".trace", "wb") as out:
+				trace_store.write_trace(out, run_time_data)
+		sections["trace_store"] = out_file + ".trace"
+	if scenarios != None and scenarios.index == 0:
+		scenarios.wait()
+		sections["scenarios"] = scenarios.outputs(file)
+	if stats != None:
+		sections["stats"] = stats.to_json()
+	if len(sections) > 0:
+		# The optional sections go after the 3 mandatory elements, so
+		# the serialize time of the main payload can be part of them
+		result = result[:-1] + ", " + json.dumps(sections) + "]"
+
+	with output_file(out_file + ".out") as out:
+		out.write(result)
+
+	if scenarios != None and scenarios.index > 0:
+		# forked children must not go back to the rest of run.py
+		if exception != None:
+			traceback.print_exception(exception)
+		sys.stdout.flush()
+		sys.stderr.flush()
+		os._exit(0)
 	if exception != None:
 		raise exception
 
+def profiled_main(file, values_file = None):
+	# RUNPY_PROFILE=cprofile dumps a cProfile of the whole run to <file>.prof,
+	# RUNPY_PROFILE=tracemalloc dumps a tracemalloc snapshot to <file>.tracemalloc
+	profile = os.environ.get("RUNPY_PROFILE", "")
+	if profile == "cprofile":
+		import cProfile
+		profiler = cProfile.Profile()
+		try:
+			profiler.runcall(main, file, values_file)
+		finally:
+			profiler.dump_stats(file + ".prof")
+	elif profile == "tracemalloc":
+		import tracemalloc
+		tracemalloc.start()
+		try:
+			main(file, values_file)
+		finally:
+			tracemalloc.take_snapshot().dump(file + ".tracemalloc")
+			tracemalloc.stop()
+	else:
+		main(file, values_file)
+
 if __name__ == '__main__':
 	# The following adds the current working directory to the path
 	# so that imports look at the current working directory.
 	# (by default they look at the directory of the script)
 	sys.path.append(os.getcwd())
 	if len(sys.argv) > 2:
-		main(sys.argv[1], sys.argv[2])
+		profiled_main(sys.argv[1], sys.argv[2])
 	else:
-		main(sys.argv[1])
+		profiled_main(sys.argv[1])
@@ -0,0 +1,75 @@
+import builtins
+import os
+import sys
+from time import perf_counter
+
+# Startup timing of run.py (RUNPY_STARTUP_BUDGET=MS). run.py imports this
+# module first, so that the timer sees the imports that follow, like
+# python -X importtime does. The time python takes to start before running
+# run.py is not included.
+
+started = perf_counter()
+
+class ImportTimer:
+	def __init__(self, budget_ms):
+		self.budget_ms = budget_ms
+		# module -> [self ms, cumulative ms] of the modules loaded while installed
+		self.modules = {}
+		# cumulative ms of the imports nested in each import in progress
+		self.nested = []
+		self.original_import = builtins.__import__
+
+	def install(self):
+		builtins.__import__ = self.timed_import
+
+	def uninstall(self):
+		builtins.__import__ = self.original_import
+
+	def loads_module(self, name, fromlist, level):
+		if level > 0:
+			return False
+		if not name in sys.modules:
+			return True
+		# from package import submodule
+		module = sys.modules[name]
+		for x in fromlist or ():
+			if x != "*" and not hasattr(module, x) and not (name + "." + x) in sys.modules:
+				return True
+		return False
+
+	def timed_import(self, name, globals = None, locals = None, fromlist = (), level = 0):
+		if not self.loads_module(name, fromlist, level):
+			return self.original_import(name, globals, locals, fromlist, level)
+		self.nested.append(0)
+		start = perf_counter()
+		try:
+			return self.original_import(name, globals, locals, fromlist, level)
+		finally:
+			total = (perf_counter() - start) * 1000
+			nested = self.nested.pop()
+			if len(self.nested) > 0:
+				self.nested[-1] += total
+			times = self.modules.setdefault(name, [0, 0])
+			times[0] += total - nested
+			times[1] += total
+
+	def report(self):
+		# called when the program is about to run, which ends the startup
+		self.uninstall()
+		total = (perf_counter() - started) * 1000
+		modules = sorted(self.modules.items(), key = lambda item: -item[1][0])
+		return {
+			"total_ms": round(total, 3),
+			"budget_ms": self.budget_ms,
+			"over_budget": total > self.budget_ms,
+			"imports_ms": {name: [round(s, 3), round(c, 3)] for (name, (s, c)) in modules},
+		}
+
+timer = None
+if os.environ.get("RUNPY_STARTUP_BUDGET", "") != "":
+	timer = ImportTimer(float(os.environ["RUNPY_STARTUP_BUDGET"]))
+	timer.install()
+
+def describe(report, count = 5):
+	slowest = ", ".join("%s %.1f ms" % (name, times[0]) for (name, times) in list(report["imports_ms"].items())[:count])
+	return "Startup took %.1f ms, over the budget of %s ms. Slowest imports: %s" % (report["total_ms"], report["budget_ms"], slowest)
@@ -1,9 +1,13 @@
 import sys
+import os
 import ast
 import json
+import hashlib
+import tempfile
+import threading
 import core
 
-reserved_names = ["time", "#", "$", "lineno", "prev_lineno", "next_lineno", "__run_py__"]
+reserved_names = ["time", "#", "$", "lineno", "prev_lineno", "next_lineno", "call", "sampled", "Net alloc", "Peak alloc", "__run_py__"]
 
 patterns = ["# = #.split(',')",
 			"# = #.split(';')",
@@ -43,11 +47,27 @@ def compute_list_of_vars(code):
 	var_collector.visit(root)
 	return var_collector.vars
 
-def run_stmt(setup, stmt):
+# statements are compiled once, and reused for every problem (up to
+# max_compiled_stmts of them)
+compiled_stmts = {}
+max_compiled_stmts = 100000
+
+def compile_stmt(stmt):
+	if not stmt in compiled_stmts:
+		if len(compiled_stmts) >= max_compiled_stmts:
+			compiled_stmts.clear()
+		try:
+			compiled_stmts[stmt] = compile(stmt, "<synth>", "exec")
+		except SyntaxError:
+			compiled_stmts[stmt] = None
+	return compiled_stmts[stmt]
+
+def run_stmt(setup, code):
 	locals = {}
 	globals = {}
 	try:
-		exec(setup + stmt, globals, locals)
+		exec(setup, globals, locals)
+		exec(code, globals, locals)
 	except:
 		pass
 	return locals
@@ -65,6 +85,18 @@ def expand_all_patterns(vars):
 		expand_pattern(pattern, vars, result_stmts)
 	return result_stmts
 
+# the statements for the last few sets of names
+expanded_patterns = {}
+max_expanded_patterns = 16
+
+def expand_all_patterns_cached(vars):
+	key = tuple(sorted(vars))
+	if not key in expanded_patterns:
+		if len(expanded_patterns) >= max_expanded_patterns:
+			del expanded_patterns[next(iter(expanded_patterns))]
+		expanded_patterns[key] = expand_all_patterns(key)
+	return expanded_patterns[key]
+
 def compute_setup(before):
 	setup = ""
 	for v in before.keys():
@@ -81,11 +113,20 @@ def results_eq(goal, actual):
 				return False
 	return True
 
-def try_all_stmts(stmts, before, after):
-	setup = compute_setup(before)
+def try_all_stmts(stmts, examples, cancelled = lambda: False):
+	# the first statement that gives the after values of every
+	# (before, after) example, None if there is none or if cancelled
+	try:
+		setups = [compile(compute_setup(before), "<synth>", "exec") for (before, _) in examples]
+	except SyntaxError:
+		return None
 	for stmt in stmts:
-		actual = run_stmt(setup, stmt)
-		if (results_eq(after, actual)):
+		if cancelled():
+			return None
+		code = compile_stmt(stmt)
+		if code == None:
+			continue
+		if all(results_eq(after, run_stmt(setup, code)) for (setup, (_, after)) in zip(setups, examples)):
 			return stmt
 	return None
 
@@ -110,23 +151,205 @@ def load_example(filename):
 	print(after)
 	return (before, after)
 
+# Results are cached on disk, one file per problem, named by the hash of
+# its normalized form: the setup and goal values, the names the
+# statements are built from, and the pattern set. The cache keeps the
+# SYNTH_CACHE_SIZE most recently used results (mtime is the last use).
+cache_dir = os.environ.get("SYNTH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "rtv", "synth"))
+cache_size = int(os.environ.get("SYNTH_CACHE_SIZE", "1000"))
+
+def patterns_hash():
+	return hashlib.sha256("\n".join(patterns).encode()).hexdigest()
+
+def cache_key(vars, examples):
+	normalized = []
+	for (before, after) in examples:
+		goal = {}
+		for v in after.keys():
+			if (not reserved_name(v)):
+				goal[v] = repr(after[v])
+		normalized.append([compute_setup(before), sorted(goal.items())])
+	problem = [normalized, sorted(vars), patterns_hash()]
+	return hashlib.sha256(json.dumps(problem).encode()).hexdigest()
+
+def cache_path(key):
+	return os.path.join(cache_dir, key + ".json")
+
+def cache_lookup(key):
+	# returns (found, synthesized)
+	path = cache_path(key)
+	try:
+		with open(path) as f:
+			synthesized = json.load(f)
+		os.utime(path)
+		return (True, synthesized)
+	except (OSError, ValueError):
+		return (False, None)
+
+def cache_store(key, synthesized):
+	try:
+		os.makedirs(cache_dir, exist_ok = True)
+		(fd, tmp) = tempfile.mkstemp(dir = cache_dir, suffix = ".tmp")
+		with os.fdopen(fd, "w") as f:
+			json.dump(synthesized, f)
+		os.replace(tmp, cache_path(key))
+		evict_cache()
+	except OSError as e:
+		print("Could not cache result: " + str(e), file = sys.stderr)
+
+def evict_cache():
+	entries = []
+	for name in os.listdir(cache_dir):
+		if name.endswith(".json"):
+			path = os.path.join(cache_dir, name)
+			try:
+				entries.append((os.stat(path).st_mtime, path))
+			except OSError:
+				pass
+	entries.sort()
+	for (_, path) in entries[:max(0, len(entries) - cache_size)]:
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+
 def write_output(synthesized):
 	if synthesized == None:
 		synthesized = "None"
 	with open(sys.argv[1] + ".out", "w") as out:
 		out.write(synthesized)
 
+# Server mode (synth.py --server) speaks the line protocol of
+# LocalSynthProcess: one json problem per line on stdin ({id, varNames,
+# previousEnvs, envs, optEnvs}), and one json result per line on stdout
+# ({id, success, result}). The expanded patterns, compiled statements and
+# results stay in memory between problems. A problem is dropped, without
+# a result, when a newer one for the same box (the optional "box" of the
+# problem) arrives, as the editor only waits for the last one.
+
+class ProblemQueue:
+	def __init__(self):
+		self.problems = []
+		# box -> id of its newest problem
+		self.latest = {}
+		self.closed = False
+		self.condition = threading.Condition()
+
+	def put(self, problem):
+		with self.condition:
+			self.problems.append(problem)
+			self.latest[problem.get("box")] = problem["id"]
+			self.condition.notify()
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify()
+
+	def get(self):
+		# the next problem, None once stdin is closed and all are done
+		with self.condition:
+			while len(self.problems) == 0 and not self.closed:
+				self.condition.wait()
+			if len(self.problems) == 0:
+				return None
+			return self.problems.pop(0)
+
+	def superseded(self, problem):
+		return self.latest.get(problem.get("box")) != problem["id"]
+
+output_lock = threading.Lock()
+results = {}
+
+def write_result(result):
+	with output_lock:
+		sys.stdout.write(json.dumps(result) + "\n")
+		sys.stdout.flush()
+
+def read_problems(queue):
+	for line in sys.stdin:
+		if line.strip() == "":
+			continue
+		try:
+			problem = json.loads(line)
+			if not isinstance(problem, dict) or not "id" in problem:
+				raise ValueError("a problem is an object with an id")
+		except ValueError as e:
+			write_result({"id": -1, "success": False, "result": "Bad problem: " + str(e)})
+			continue
+		queue.put(problem)
+	queue.close()
+
+def load_problem(problem):
+	# (vars, examples) of a problem: the after values of every env it has to
+	# produce, from the envs before them
+	examples = []
+	vars = set(problem["varNames"])
+	for env in problem["envs"]:
+		before = problem["previousEnvs"].get(str(env["time"]), {})
+		before = {v: before[v] for v in before if v.isidentifier() and not reserved_name(v)}
+		after = {v: eval(env[v]) for v in problem["varNames"] if v in env}
+		vars.update(before.keys())
+		examples.append((before, after))
+	return (vars, examples)
+
+def solve(problem, cancelled):
+	# the result for the problem, None if it was cancelled
+	(vars, examples) = load_problem(problem)
+	key = cache_key(vars, examples)
+	if key in results:
+		synthesized = results[key]
+	else:
+		(found, synthesized) = cache_lookup(key)
+		if (not found):
+			synthesized = try_all_stmts(expand_all_patterns_cached(vars), examples, cancelled)
+			if cancelled():
+				return None
+			cache_store(key, synthesized)
+		results[key] = synthesized
+		if len(results) > cache_size:
+			del results[next(iter(results))]
+	if synthesized == None:
+		return {"id": problem["id"], "success": False}
+	return {"id": problem["id"], "success": True, "result": synthesized}
+
+def serve():
+	queue = ProblemQueue()
+	threading.Thread(target = read_problems, args = (queue,), daemon = True).start()
+	while True:
+		problem = queue.get()
+		if problem == None:
+			break
+		cancelled = lambda: queue.superseded(problem)
+		if cancelled():
+			continue
+		try:
+			result = solve(problem, cancelled)
+		except Exception as e:
+			result = {"id": problem["id"], "success": False, "result": "%s: %s" % (type(e).__name__, e)}
+		if result != None:
+			write_result(result)
+
 def main():
 
+	if len(sys.argv) == 2 and sys.argv[1] == "--server":
+		serve()
+		return
+
 	if len(sys.argv) != 3:
-		print("Usage: run <example-file-name> <code-file-name>")
+		print("Usage: run <example-file-name> <code-file-name> | run --server")
 		exit(-1)
 
 	code = load_code(sys.argv[2])
 	(before, after) = load_example(sys.argv[1])
 	vars = compute_list_of_vars(code)
-	stmts = expand_all_patterns(vars)
-	synthesized = try_all_stmts(stmts, before, after)
+	examples = [(before, after)]
+	key = cache_key(vars, examples)
+	(found, synthesized) = cache_lookup(key)
+	if (not found):
+		stmts = expand_all_patterns(vars)
+		synthesized = try_all_stmts(stmts, examples)
+		cache_store(key, synthesized)
 	write_output(synthesized)
 
 main()
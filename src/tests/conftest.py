@@ -0,0 +1,5 @@
+import os
+import sys
+
+# run.py and the modules it uses are imported from src, as run.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,72 @@
+import re
+
+import pytest
+
+from test_run import run_program
+
+# Programs the two backends (RUNPY_BACKEND=bdb and ast) trace the same way
+SAME = {
+	"loops": "s = 0\nfor i in range(4):\n    if i % 2 == 0:\n        s += i\n    else:\n        continue\nwhile s > 0:\n    s -= 1\n",
+	"recursion": "def fact(n):\n    if n <= 1:\n        return 1\n    return n * fact(n - 1)\nx = fact(4)\n",
+	"generator": "def gen(n):\n    for i in range(n):\n        yield i * 2\nxs = []\nfor v in gen(3):\n    xs.append(v)\n",
+	"generator in a call": "def gen(n):\n    for i in range(n):\n        yield i\ndef total(n):\n    t = 0\n    for v in gen(n):\n        t += v\n    return t\nz = total(3)\n",
+	"generator left early": "def gen():\n    i = 0\n    while True:\n        yield i\n        i += 1\nfor v in gen():\n    if v > 2:\n        break\n",
+	"generator send": "def gen():\n    a = yield 1\n    yield a\ng = gen()\nx = next(g)\ny = g.send(7)\n",
+	"list and dict comprehensions": "xs = [i * i for i in range(4)]\nd = {i: i + 1 for i in xs}\n",
+	"exception": "def f(x):\n    if x > 1:\n        raise ValueError('big')\n    return x\ntry:\n    y = f(3)\nexcept ValueError as e:\n    y = 0\n",
+	"classes": "class A:\n    def __init__(self, v):\n        self.v = v\n    def get(self):\n        return self.v\na = A(2)\nb = a.get()\n",
+}
+
+# The differences we allow, with the envs of the bdb trace that the AST
+# backend doesn't have. The other envs are the same, apart from their
+# times and the prev/next links around the envs left out.
+def comprehension_frame(env, lines):
+	# bdb traces generator expressions and set comprehensions (only list
+	# and dict comprehensions are left out), the AST backend none of them
+	return ".0" in env
+
+def yield_from_return(env, lines):
+	# bdb gets a return of the delegating generator for every value it
+	# passes on, the instrumented code only sees its own yields
+	lineno = str(env["lineno"])
+	return lineno.startswith("R") and "yield from" in lines[int(lineno[1:])]
+
+DIFFERENT = {
+	"generator expressions": ("data = [3, 1, 2]\nt = sum(x * 2 for x in data)\nok = any(x > 2 for x in data)\n", comprehension_frame),
+	"set comprehension": ("xs = [1, 2, 2]\ns = {v + 1 for v in xs}\n", comprehension_frame),
+	"yield from": ("def gen():\n    yield 1\n    return 5\ndef outer():\n    r = yield from gen()\n    yield r\nxs = list(outer())\n", yield_from_return),
+}
+
+def without_addresses(value):
+	if isinstance(value, str):
+		return re.sub(r" at 0x[0-9a-f]+", " at 0x", value)
+	if isinstance(value, list):
+		return [without_addresses(v) for v in value]
+	if isinstance(value, dict):
+		return {k: without_addresses(v) for (k, v) in value.items()}
+	return value
+
+def trace(tmp_path, source, backend):
+	(out, rc) = run_program(tmp_path, source, RUNPY_BACKEND = backend)
+	assert rc == 0 and out[0] == 0
+	return without_addresses(out)
+
+def steps(out, lines, left_out = None):
+	# the envs of the run in time order (an env can be at several lines)
+	envs = {env["time"]: env for envs in out[2].values() for env in envs if "time" in env}
+	return [{k: v for (k, v) in env.items() if not k in ("time", "prev_lineno", "next_lineno")}
+		for (_, env) in sorted(envs.items()) if left_out == None or not left_out(env, lines)]
+
+@pytest.mark.parametrize("name", sorted(SAME))
+def test_backends_trace_the_same(tmp_path, name):
+	assert trace(tmp_path, SAME[name], "ast") == trace(tmp_path, SAME[name], "bdb")
+
+@pytest.mark.parametrize("name", sorted(DIFFERENT))
+def test_backend_differences(tmp_path, name):
+	(source, left_out) = DIFFERENT[name]
+	lines = source.split("\n")
+	bdb = trace(tmp_path, source, "bdb")
+	ast = trace(tmp_path, source, "ast")
+	assert bdb != ast
+	assert steps(ast, lines) == steps(bdb, lines, left_out)
+	assert not any(left_out(env, lines) for env in steps(ast, lines))
@@ -0,0 +1,37 @@
+import pytest
+
+import core
+
+np = pytest.importorskip("numpy")
+
+def stats(summary):
+	# "min=.. max=.. mean=.. nan=.." of an ndarray summary
+	return dict(item.split("=") for item in summary.split("\n")[1].split(" "))
+
+def test_summary_sees_equal_writes():
+	a = np.zeros(1000)
+	assert stats(core.summarize_value(a))["max"] == "0.0"
+	a[10:12] = 5
+	summary = stats(core.summarize_value(a))
+	assert summary["max"] == "5.0"
+	assert summary["mean"] == "0.01"
+
+def test_summary_sees_writes_that_cancel_out():
+	b = np.arange(1000)
+	assert stats(core.summarize_value(b))["mean"] == "499.5"
+	b[500] += 2
+	b[501] += 2
+	assert stats(core.summarize_value(b))["mean"] == "499.504"
+
+def test_summary_of_read_only_arrays_is_cached():
+	a = np.arange(1000)
+	a.flags.writeable = False
+	assert core.summarize_value(a) is core.summarize_value(a)
+
+def test_summary_of_read_only_views_sees_writes():
+	a = np.zeros(1000)
+	v = a[:]
+	v.flags.writeable = False
+	assert stats(core.summarize_value(v))["max"] == "0.0"
+	a[0] = 1
+	assert stats(core.summarize_value(v))["max"] == "1.0"
@@ -0,0 +1,359 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+RUNPY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "run.py")
+
+def run_program(tmp_path, source, values = None, **env):
+	# runs run.py on source like the editor does, and returns the parsed
+	# <file>.out and the exit status
+	file = tmp_path / "tmp.py"
+	file.write_text(source)
+	args = [sys.executable, RUNPY, str(file)]
+	if values != None:
+		(tmp_path / "values.json").write_text(json.dumps(values))
+		args.append(str(tmp_path / "values.json"))
+	process = subprocess.run(args, cwd = tmp_path, env = dict(os.environ, **env), capture_output = True, text = True)
+	with open(str(file) + ".out") as f:
+		return (json.load(f), process.returncode)
+
+def history_lines(history, varname):
+	return [(lineno, history["values"][vid]) for (_, lineno, _, vid) in history["vars"][varname]]
+
+def test_history_changes_are_at_the_line_that_made_them(tmp_path):
+	source = "a = 1\nb = 2\na = 5\n"
+	(out, _) = run_program(tmp_path, source, RUNPY_HISTORY = "1")
+	history = out[3]["history"]
+	assert history_lines(history, "a") == [(0, "1"), (2, "5")]
+	assert history_lines(history, "b") == [(1, "2")]
+
+def test_history_in_loops_and_calls(tmp_path):
+	source = "def f(n):\n    m = n + 1\n    return m\nt = 0\nfor i in range(2):\n    t = f(i)\n"
+	(out, _) = run_program(tmp_path, source, RUNPY_HISTORY = "1")
+	history = out[3]["history"]
+	assert history_lines(history, "i") == [(4, "0"), (4, "1")]
+	assert history_lines(history, "t") == [(3, "0"), (5, "1"), (5, "2")]
+	# arguments are seen at the first line of the call
+	assert history_lines(history, "n") == [(1, "0"), (1, "1")]
+	assert history_lines(history, "m") == [(1, "1"), (1, "2")]
+
+def test_timeout_writes_the_data_so_far(tmp_path):
+	(out, _) = run_program(tmp_path, "i = 0\nwhile True:\n    i = i + 1\n", RUNPY_TIMEOUT = "0.5", RUNPY_SAMPLE = "1000,1")
+	assert out[0] == 3
+	assert out[3]["stopped"] == "timeout"
+
+def test_cancelled_run_writes_nothing(tmp_path):
+	file = tmp_path / "tmp.py"
+	file.write_text("i = 0\nwhile True:\n    i = i + 1\n")
+	# sampling, so that the program runs past the 1000 steps limit
+	process = subprocess.Popen([sys.executable, RUNPY, str(file)], cwd = tmp_path, env = dict(os.environ, RUNPY_SAMPLE = "1000,1"), stderr = subprocess.PIPE, text = True)
+	time.sleep(1)
+	process.terminate()
+	(_, err) = process.communicate(timeout = 10)
+	assert "Run stopped: cancelled" in err
+	assert sorted(os.listdir(tmp_path)) == ["tmp.py"]
+
+def test_cancelled_run_ends_in_a_sleep(tmp_path):
+	# the program never gets to another line, and the ones that catch the
+	# stop get the default action of SIGALRM
+	file = tmp_path / "tmp.py"
+	for source in ["import time\ntime.sleep(20)\n", "import time\nwhile True:\n    try:\n        time.sleep(20)\n    except BaseException:\n        pass\n"]:
+		file.write_text(source)
+		process = subprocess.Popen([sys.executable, RUNPY, str(file)], cwd = tmp_path, stderr = subprocess.PIPE, text = True)
+		time.sleep(1)
+		start = time.time()
+		process.terminate()
+		process.communicate(timeout = 10)
+		assert time.time() - start < 4
+		assert sorted(os.listdir(tmp_path)) == ["tmp.py"]
+
+def test_loop_summary_counts_every_step(tmp_path):
+	(out, _) = run_program(tmp_path, "i = 0\nwhile True:\n    i = i + 1\n", RUNPY_LOOP_SUMMARY = "2")
+	assert out[0] == 0
+	summary = out[3]["loop_summary"]["1"]["i"]
+	assert summary["count"] <= 1000
+	assert summary["last"] == summary["max"]
+
+def test_loop_summary_of_values_not_printed(tmp_path):
+	source = "xs = []\nfor i in range(40):\n    xs = xs + [i]\n"
+	(out, _) = run_program(tmp_path, source, RUNPY_LOOP_SUMMARY = "2")
+	summary = out[3]["loop_summary"]["1"]
+	# the variables are summarized at the loop header and in the body
+	assert summary["i"]["count"] == 80
+	assert summary["i"]["last"] == "39"
+	assert summary["xs"]["count"] == 80
+	# the last kept iteration is 32
+	assert summary["xs"]["last"] == repr(list(range(33)))
+
+def test_calls_after_finished_generators(tmp_path):
+	# frames of finished generators must not hand their call on to the
+	# frames that come after them
+	source = "def gen():\n    yield 1\ndef f(x):\n    return x\nfor i in range(20):\n    for v in gen():\n        pass\n    f(i)\n"
+	(out, _) = run_program(tmp_path, source, RUNPY_CALL_DEPTH = "5")
+	calls = out[3]["calls"].values()
+	assert len([call for call in calls if call["name"] == "gen"]) == 20
+	assert len([call for call in calls if call["name"] == "f"]) == 20
+	assert all(call["depth"] == 1 and call["parent"] != None for call in calls if call["name"] != "<module>")
+
+def test_memory_of_steps_that_are_not_recorded(tmp_path):
+	# each step appends a list of about 80kB, whether its env is kept or
+	# not, and no env counts more than one of them
+	source = "xs = []\nfor i in range(20):\n    xs.append([0] * 10000)\ny = 1\n"
+	(out, _) = run_program(tmp_path, source, RUNPY_LOOP_SUMMARY = "2", RUNPY_MEMORY_TRACE = "1")
+	allocated = [int(env["Net alloc"]) for envs in out[2].values() for env in envs if "Net alloc" in env]
+	assert max(allocated) > 80000
+	assert max(allocated) < 100000
+
+def test_np_without_import(tmp_path):
+	# np, plt and Image are there without an import, as they used to be
+	source = "a = np.zeros(3)\nb = float(a.sum())\nc = eval('np.ones(2)').size\n"
+	(out, rc) = run_program(tmp_path, source)
+	assert rc == 0 and out[0] == 0
+	assert out[2]["2"][0]["b"] == "0.0"
+	assert out[2]["2"][0]["c"] == "2"
+
+def test_focus_after_a_long_loop(tmp_path):
+	# the steps of the loop are out of focus, so they leave the whole
+	# limit to the function
+	source = "xs = []\nfor i in range(2000):\n    xs.append(i)\ndef f(n):\n    t = n + 1\n    return t\ny = f(3)\n"
+	(out, rc) = run_program(tmp_path, source, RUNPY_FOCUS_FUNCTIONS = "f")
+	assert rc == 0
+	assert sorted(out[2]) == ["3", "4", "5", "R5"]
+	assert out[2]["5"][0]["t"] == "4"
+	(out, rc) = run_program(tmp_path, source, RUNPY_FOCUS = "7")
+	assert list(out[2]) == ["6"]
+
+def test_step_limit_is_reported(tmp_path):
+	(out, rc) = run_program(tmp_path, "i = 0\nwhile True:\n    i += 1\n")
+	assert out[0] == 0
+	assert out[3]["step_limit"] == 1000
+	(out, rc) = run_program(tmp_path, "i = 0\n")
+	assert len(out) == 3
+
+def test_abandoned_generators_are_not_kept(tmp_path):
+	# any() drops the generator at its first yield, with b in its locals
+	source = "import weakref\nclass Big:\n    pass\ndef check():\n    b = Big()\n    any(x is b for x in [b])\n    return weakref.ref(b)\nr = check()\nalive = r() != None\n"
+	(out, rc) = run_program(tmp_path, source)
+	assert rc == 0
+	assert out[2]["8"][0]["alive"] == "False"
+
+def distinct_envs(out):
+	# the envs of the run by time (an env can be at several lines)
+	return {env["time"]: env for envs in out[2].values() for env in envs if "time" in env}
+
+def test_stats(tmp_path):
+	(out, _) = run_program(tmp_path, "s = 0\nfor i in range(3):\n    s += i\n", RUNPY_STATS = "1")
+	stats = out[3]["stats"]
+	assert {"parse", "trace", "repr", "serialize"} <= set(stats["phases_ms"])
+	# every env is counted, including the ones left out of the output
+	# once the values are moved to the line they follow
+	envs = distinct_envs(out)
+	assert stats["events"] == max(envs) + 1
+	assert stats["repr_calls"] >= sum(len([k for k in env if k in ("s", "i")]) for env in envs.values())
+	assert set(stats["repr_bytes"]) == {"s", "i"}
+	for name in ("s", "i"):
+		assert stats["repr_bytes"][name] >= sum(len(env[name]) for env in envs.values() if name in env)
+
+def test_cprofile(tmp_path):
+	run_program(tmp_path, "x = 1\n", RUNPY_PROFILE = "cprofile")
+	import pstats
+	assert pstats.Stats(str(tmp_path / "tmp.py.prof")).total_calls > 0
+
+def test_calls_deeper_than_the_depth_are_sliced_out(tmp_path):
+	source = "def fact(n):\n    if n <= 1:\n        return 1\n    return n * fact(n - 1)\nx = fact(4)\n"
+	(out, _) = run_program(tmp_path, source, RUNPY_CALL_DEPTH = "1")
+	calls = out[3]["calls"]
+	assert [(calls[fid]["name"], calls[fid]["depth"]) for fid in sorted(calls, key = int)] == [("<module>", 0)] + [("fact", d) for d in range(1, 5)]
+	for env in distinct_envs(out).values():
+		assert calls[str(env["call"])]["depth"] <= 1
+	# each deep call is read on its own, from its slice
+	with open(tmp_path / "tmp.py.calls", "rb") as f:
+		content = f.read()
+	ns = set()
+	for (fid, call) in calls.items():
+		assert ("slice" in call) == (call["depth"] > 1)
+		if "slice" in call:
+			(offset, length) = call["slice"]
+			data = json.loads(content[offset:offset + length])
+			envs = [env for envs in data.values() for env in envs]
+			assert all(env["call"] == int(fid) for env in envs)
+			ns |= {env["n"] for env in envs}
+	assert ns == {"1", "2", "3"}
+
+FOCUS_SOURCE = "def heavy(n):\n    t = 0\n    for i in range(n):\n        t += i\n    return t\ndef f(x):\n    y = x + 1\n    return y\na = heavy(3000)\nb = f(a)\nc = b * 2\n"
+
+def test_focus_on_lines(tmp_path):
+	# heavy runs untraced, so its steps don't count
+	(out, rc) = run_program(tmp_path, FOCUS_SOURCE, RUNPY_FOCUS = "10-11")
+	assert rc == 0 and len(out) == 3
+	assert sorted(out[2]) == ["10", "9"]
+	assert out[2]["10"][0]["c"] == "8997002"
+
+def test_focus_on_functions(tmp_path):
+	(out, rc) = run_program(tmp_path, FOCUS_SOURCE, RUNPY_FOCUS_FUNCTIONS = "f")
+	assert rc == 0 and len(out) == 3
+	# the def line of f is in focus too
+	assert sorted(out[2]) == ["5", "6", "7", "R7"]
+	assert out[2]["7"][0]["y"] == "4498501"
+	assert all(not "t" in env for env in distinct_envs(out).values())
+
+def test_scenarios_fork_from_a_checkpoint(tmp_path):
+	source = "a = 1\nb = a + 1\nc = b * 10\n"
+	values = [{"(1,1)": {"a": "5"}}, {"(1,1)": {"a": "7"}}, {}]
+	(out, rc) = run_program(tmp_path, source, values)
+	assert rc == 0
+	names = ["tmp.py.out", "tmp.py.1.out", "tmp.py.2.out"]
+	assert out[3] == {"scenario": 0, "scenarios": [str(tmp_path / name) for name in names]}
+	results = [out]
+	for i in (1, 2):
+		with open(str(tmp_path / names[i])) as f:
+			results.append(json.load(f))
+		assert results[i][0] == 0 and results[i][3] == {"scenario": i}
+	assert [r[2]["2"][0]["c"] for r in results] == ["60", "80", "20"]
+
+def test_threads_are_traced(tmp_path):
+	source = "import threading\ndef work(n):\n    s = 0\n    for i in range(n):\n        s += i\n    return s\nt = threading.Thread(target=work, args=(3,))\nt.start()\nt.join()\nx = work(2)\n"
+	(out, rc) = run_program(tmp_path, source)
+	assert rc == 0
+	# the envs of both threads are at the lines of work, in time order
+	for envs in out[2].values():
+		times = [env["time"] for env in envs if "time" in env]
+		assert times == sorted(times)
+	assert [(env["n"], env["s"]) for env in out[2]["5"]] == [("3", "3"), ("2", "1")]
+	assert [env["i"] for env in out[2]["4"] if "i" in env] == ["0", "1", "2", "0", "1"]
+
+def test_threads_that_outlive_the_run_are_stopped(tmp_path):
+	source = "import threading\ndef spin():\n    k = 0\n    while True:\n        k += 1\nt = threading.Thread(target=spin)\nt.start()\nx = 1\n"
+	(out, rc) = run_program(tmp_path, source)
+	assert rc == 0 and out[0] == 0
+	assert out[2]["7"][0]["x"] == "1"
+	assert len(out[2]["4"]) > 0
+
+def test_startup_over_budget(tmp_path):
+	(out, rc) = run_program(tmp_path, "x = 1\n", RUNPY_STARTUP_BUDGET = "0")
+	assert rc == 0 and out[0] == 0
+	report = out[3]["startup"]
+	assert report["over_budget"] == True and report["budget_ms"] == 0 and report["total_ms"] > 0
+	assert out[2]["0"][0]["x"] == "1"
+	(out, _) = run_program(tmp_path, "x = 1 / 0\n", RUNPY_STARTUP_BUDGET = "0")
+	assert out[0] == 2 and out[3]["startup"]["over_budget"] == True
+	(out, rc) = run_program(tmp_path, "x = 1\n", RUNPY_STARTUP_BUDGET = "100000")
+	assert rc == 0 and out[3]["startup"]["over_budget"] == False
+
+EXAMPLES_SOURCE = "def f(n):\n    s = 0\n    for i in range(n):\n        s += i\n    return s\ndef g(x):\n    return 10 // x\nbase = 1\n"
+
+def run_examples(tmp_path, examples, **env):
+	(tmp_path / "examples.json").write_text(json.dumps(examples))
+	return run_program(tmp_path, EXAMPLES_SOURCE, RUNPY_EXAMPLES = str(tmp_path / "examples.json"), **env)
+
+def test_examples(tmp_path):
+	examples = {"a": {"function": "f", "args": ["3"]}, "b": {"function": "g", "args": ["0"]}, "c": {"function": "g", "args": ["base + 1"]}}
+	(out, rc) = run_examples(tmp_path, examples)
+	assert rc == 0 and out[0] == 0
+	results = out[3]["examples"]
+	assert sorted(results) == ["a", "b", "c"]
+	a = results["a"]
+	assert a["return_code"] == 0
+	assert a["run_time_data"]["4"][0]["rv"] == "3"
+	assert [env["i"] for env in a["run_time_data"]["2"]] == ["0", "1", "2"]
+	# calls run in the state the program ended in
+	assert results["c"]["run_time_data"]["6"][0]["rv"] == "5"
+	assert results["b"]["return_code"] == 2
+	assert results["b"]["exception"] == "ZeroDivisionError: integer division or modulo by zero"
+
+def test_examples_in_a_list(tmp_path):
+	examples = [{"function": "g", "args": [str(x)]} for x in range(1, 6)]
+	(out, _) = run_examples(tmp_path, examples, RUNPY_EXAMPLE_WORKERS = "2")
+	results = out[3]["examples"]
+	assert sorted(results) == ["0", "1", "2", "3", "4"]
+	assert [results[str(i)]["run_time_data"]["6"][0]["rv"] for i in range(5)] == ["10", "5", "3", "2", "2"]
+
+def test_sample_bursts(tmp_path):
+	# cpu bound, as the interval is in cpu time
+	source = "s = 0\nfor i in range(3000000):\n    s += i % 7\nt = s\n"
+	(out, rc) = run_program(tmp_path, source, RUNPY_SAMPLE = "20,1")
+	assert rc == 0 and out[0] == 0
+	body = out[2]["2"]
+	envs = [env for env in body if "time" in env]
+	bursts = sorted(set(env["sampled"] for env in envs))
+	assert len(bursts) > 1 and bursts == list(range(1, bursts[-1] + 1))
+	for env in envs:
+		n = int(env["i"]) + 1
+		assert int(env["s"]) == 21 * (n // 7) + sum(range(n % 7))
+	# the loop starts over in every burst, and bursts are apart in time
+	assert len([env for env in body if "begin_loop" in env]) == len(bursts)
+	last_time = None
+	for burst in bursts:
+		in_burst = [env for env in envs if env["sampled"] == burst]
+		assert [env["#"] for env in in_burst] == [str(k) for k in range(len(in_burst))]
+		assert [int(env["i"]) for env in in_burst] == list(range(int(in_burst[0]["i"]), int(in_burst[0]["i"]) + len(in_burst)))
+		if last_time != None:
+			assert in_burst[0]["time"] > last_time + 2
+		last_time = in_burst[-1]["time"]
+
+def merge_diff(envs, out):
+	# what the editor does with the output of a run against the envs it shows
+	diff = out[3]["diff"]
+	if diff["base"] == None:
+		return out[2]
+	merged = {l: e for (l, e) in envs.items() if not l in diff["removed"]}
+	merged.update(out[2])
+	return merged
+
+def test_diff_merges_into_the_previous_envs(tmp_path):
+	# a line changed and one added, the same program again, lines removed
+	sources = ["a = 1\nb = 2\nc = a + b\n", "a = 1\nb = 5\nc = a + b\nd = c\n", "a = 1\nb = 5\nc = a + b\nd = c\n", "a = 1\nb = 5\n"]
+	(out, _) = run_program(tmp_path, sources[0], RUNPY_DIFF = "new")
+	assert out[3]["diff"]["base"] == None
+	(envs, run) = (out[2], out[3]["diff"]["run"])
+	diffs = []
+	for source in sources[1:]:
+		(full, _) = run_program(tmp_path, source)
+		(out, rc) = run_program(tmp_path, source, RUNPY_DIFF = run)
+		assert rc == 0 and out[0] == 0
+		diff = out[3]["diff"]
+		assert diff["base"] == run
+		assert sorted(out[2]) == sorted(diff["changed"] + diff["added"])
+		assert sorted(diff["unchanged"] + diff["changed"] + diff["added"]) == sorted(full[2])
+		envs = merge_diff(envs, out)
+		assert envs == full[2]
+		run = diff["run"]
+		diffs.append(diff)
+	assert "1" in diffs[0]["changed"] and "4" in diffs[0]["added"] and "0" in diffs[0]["unchanged"]
+	assert diffs[1]["changed"] == diffs[1]["added"] == diffs[1]["removed"] == []
+	assert diffs[1]["run"] == diffs[1]["base"]
+	assert "3" in diffs[2]["removed"] and "0" in diffs[2]["unchanged"]
+
+def test_diff_against_another_run_sends_everything(tmp_path):
+	run_program(tmp_path, "a = 1\n", RUNPY_DIFF = "new")
+	(out, _) = run_program(tmp_path, "a = 2\n", RUNPY_DIFF = "old")
+	assert out[3]["diff"]["base"] == None
+	assert out[2]["0"][0]["a"] == "2"
+
+PROFILE_SOURCE = "import time\ndef f(n):\n    s = 0\n    for i in range(n):\n        s += i\n    return s\ndef slow():\n    time.sleep(0.05)\nx = f(10)\nslow()\ny = f(2000)\n"
+
+def test_line_profile(tmp_path):
+	(out, rc) = run_program(tmp_path, PROFILE_SOURCE, RUNPY_LINE_PROFILE = "1")
+	assert rc == 0 and out[0] == 0
+	profile = out[3]["profile"]
+	lines = profile["lines"]
+	# the envs stop at the step limit, and so do the counts
+	assert "step_limit" in out[3] and out[2]["8"][0]["x"] == "45"
+	assert [lines[l][0] for l in ("0", "1", "7", "8", "9")] == [1, 1, 1, 1, 1]
+	assert lines["3"][0] == lines["4"][0] + 1
+	# untraced calls count for the line that makes them
+	assert lines["7"][1] >= 50 * 10 ** 6
+	assert profile["functions"]["slow"] == [1, 1, lines["7"][1]]
+	assert profile["functions"]["f"][0] >= 1 and profile["overhead_ns"] > 0
+	assert sum(ns for (_, ns) in lines.values()) == sum(ns for (_, _, ns) in profile["functions"].values())
+
+def test_line_profile_only(tmp_path):
+	(out, rc) = run_program(tmp_path, PROFILE_SOURCE, RUNPY_LINE_PROFILE = "only")
+	assert rc == 0 and out[0] == 0
+	assert out[2] == {} and not "step_limit" in out[3]
+	lines = out[3]["profile"]["lines"]
+	assert [lines[l][0] for l in ("2", "3", "4", "5")] == [2, 2012, 2010, 2]
+	assert out[3]["profile"]["functions"]["f"][:2] == [2, sum(lines[l][0] for l in ("2", "3", "4", "5"))]
+	assert lines["7"][1] >= 50 * 10 ** 6
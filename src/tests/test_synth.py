@@ -0,0 +1,86 @@
+import json
+import os
+import subprocess
+import sys
+
+SYNTH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "synth.py")
+
+def synthesize(tmp_path, before, after, code, **env):
+	# runs synth.py on one example like the scala synthesizer is, and returns
+	# the synthesized statement
+	example = tmp_path / "example.json"
+	example.write_text(json.dumps([before, after]))
+	file = tmp_path / "code.py"
+	file.write_text(code)
+	env = dict(os.environ, SYNTH_CACHE_DIR = str(tmp_path / "cache"), **env)
+	subprocess.run([sys.executable, SYNTH, str(example), str(file)], env = env, capture_output = True, check = True)
+	return (tmp_path / "example.json.out").read_text()
+
+def cached(tmp_path):
+	return sorted((tmp_path / "cache").glob("*.json"))
+
+def test_results_are_cached_on_disk(tmp_path):
+	(before, after) = ({"s": "'a,b'"}, {"x": "['a', 'b']"})
+	assert synthesize(tmp_path, before, after, "x = s\n") == "x = s.split(',')"
+	[path] = cached(tmp_path)
+	assert json.loads(path.read_text()) == "x = s.split(',')"
+	# the same problem is answered from the cache
+	path.write_text(json.dumps("x = 'cached'"))
+	assert synthesize(tmp_path, before, after, "x = s\n") == "x = 'cached'"
+	# and so are failed searches
+	assert synthesize(tmp_path, {"s": "'a'"}, {"x": "7"}, "x = s\n") == "None"
+	assert len(cached(tmp_path)) == 2
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+	examples = [({"s": "'a,b'"}, {"x": "['a', 'b']"}), ({"s": "'a;b'"}, {"x": "['a', 'b']"}), ({"s": "' a '"}, {"x": "'a'"})]
+	keys = []
+	for (before, after) in examples:
+		synthesize(tmp_path, before, after, "x = s\n", SYNTH_CACHE_SIZE = "2")
+		keys.append(set(path.name for path in cached(tmp_path)) - set().union(*keys))
+	assert [len(key) for key in keys] == [1, 1, 1]
+	assert set(path.name for path in cached(tmp_path)) == keys[1] | keys[2]
+
+def problem(id, s, x, **fields):
+	return dict({"id": id, "varNames": ["x"], "previousEnvs": {"2": {"s": repr(s)}}, "envs": [{"time": 2, "x": repr(x)}]}, **fields)
+
+def serve(tmp_path, lines):
+	env = dict(os.environ, SYNTH_CACHE_DIR = str(tmp_path / "cache"))
+	process = subprocess.run([sys.executable, SYNTH, "--server"], input = "".join(line + "\n" for line in lines), env = env, capture_output = True, text = True, check = True, timeout = 60)
+	return [json.loads(line) for line in process.stdout.splitlines()]
+
+def test_server_protocol(tmp_path):
+	# each in its own box, as problems of the same box replace each other
+	results = serve(tmp_path, [
+		json.dumps(problem(1, "a,b", ["a", "b"], box = 1)),
+		"",
+		"not json",
+		json.dumps(problem(2, "a;b", ["a", "b"], box = 2)),
+		json.dumps(problem(3, "a", 7, box = 3)),
+		json.dumps(problem(4, "a,b", ["a", "b"], box = 4)),
+	])
+	# bad lines are answered as soon as they are read
+	[bad] = [result for result in results if result["id"] == -1]
+	assert bad["success"] == False and bad["result"].startswith("Bad problem")
+	assert [result for result in results if result["id"] != -1] == [
+		{"id": 1, "success": True, "result": "x = s.split(',')"},
+		{"id": 2, "success": True, "result": "x = s.split(';')"},
+		{"id": 3, "success": False},
+		{"id": 4, "success": True, "result": "x = s.split(',')"},
+	]
+	# the server shares the disk cache with the command line
+	assert len(cached(tmp_path)) == 3
+	assert synthesize(tmp_path, {"s": "'a,b'"}, {"x": "['a', 'b']"}, "x = s\n") == "x = s.split(',')"
+	assert len(cached(tmp_path)) == 3
+
+def test_server_answers_the_newest_problem_of_a_box(tmp_path):
+	# problems of other boxes are all answered, and the last one of a box
+	# always is, whatever the older ones of that box
+	results = serve(tmp_path, [
+		json.dumps(problem(1, "a,b", ["a", "b"], box = "b1")),
+		json.dumps(problem(2, "a;b", ["a", "b"], box = "b1")),
+		json.dumps(problem(3, " a ", "a", box = "b2")),
+	])
+	by_id = {result["id"]: result for result in results}
+	assert by_id[2] == {"id": 2, "success": True, "result": "x = s.split(';')"}
+	assert by_id[3]["success"] == True
+	assert set(by_id) <= {1, 2, 3}
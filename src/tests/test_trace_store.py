@@ -0,0 +1,49 @@
+import json
+import subprocess
+import sys
+
+import trace_store
+from test_run import run_program, distinct_envs
+
+SOURCE = "s = 0\nfor i in range(4):\n    s += i\n    t = s * 2\nu = t\n"
+
+def traced(tmp_path):
+	(out, _) = run_program(tmp_path, SOURCE, RUNPY_TRACE_STORE = "1")
+	return (out, str(tmp_path / "tmp.py.trace"))
+
+def test_queries_match_the_trace(tmp_path):
+	(out, path) = traced(tmp_path)
+	data = out[2]
+	envs = distinct_envs(out)
+	with trace_store.TraceStore(path) as store:
+		assert sorted(store.lines()) == sorted(data)
+		for line in data:
+			assert store.envs_at(line) == data[line]
+		for (time, env) in envs.items():
+			assert store.env_at(time) == env
+		assert store.env_at(max(envs) + 1) == None
+		for name in ("s", "i", "t", "u"):
+			assert store.values_of(name) == [(time, env[name]) for (time, env) in sorted(envs.items()) if name in env]
+		assert store.values_of("nothing") == []
+		assert store.envs_at("nothing") == []
+
+def test_time_windows(tmp_path):
+	(out, path) = traced(tmp_path)
+	with trace_store.TraceStore(path) as store:
+		body = store.envs_at(2)
+		times = [env["time"] for env in body if "time" in env]
+		(t0, t1) = (times[1], times[2])
+		# loop markers are kept with the env they follow
+		window = store.envs_at(2, t0, t1)
+		assert [env["time"] for env in window if "time" in env] == [t0, t1]
+		assert all(env["time"] >= t0 for env in window if "time" in env)
+		assert [t for (t, _) in store.values_of("s", t0, t1)] == [t for t in sorted(distinct_envs(out)) if t0 <= t <= t1]
+
+def test_command_line(tmp_path):
+	(out, path) = traced(tmp_path)
+	script = trace_store.__file__
+	query = lambda *args: json.loads(subprocess.run([sys.executable, script, path] + list(args), capture_output = True, text = True, check = True).stdout)
+	assert sorted(query("lines")) == sorted(out[2])
+	assert query("line", "2") == out[2]["2"]
+	assert query("time", "3") == distinct_envs(out)[3]
+	assert [t for (t, _) in query("var", "u")] == [t for (t, env) in sorted(distinct_envs(out).items()) if "u" in env]
@@ -0,0 +1,260 @@
+import json
+import mmap
+import struct
+import sys
+
+# An indexed, memory-mapped store for run_time_data. The file is made of
+# fixed-size records, so that the reader can answer queries by seeking
+# into the mapped file, without deserializing the whole trace:
+#
+#   header      magic, version, and the (offset, count) of every section
+#   events      one record per env in run_time_data, grouped by line, in time order
+#   bindings    (name, value) string ids of the keys of every env, in order
+#   strings     (offset, length) of every string in the heap
+#   heap        utf-8 strings: names, line keys, and json encoded values
+#   lines       (line key, first event, event count), sorted by line key
+#   times       (time, event), sorted by time
+#   vars        (name, first var event, var event count), sorted by name
+#   var_events  (time, binding) of every env binding a variable, sorted by time
+
+MAGIC = b"RTVTRACE"
+VERSION = 1
+
+SECTIONS = ["events", "bindings", "strings", "heap", "lines", "times", "vars", "var_events"]
+HEADER = struct.Struct("<8sI" + "QQ" * len(SECTIONS))
+
+EVENT = struct.Struct("<IiiBxxxII")
+BINDING = struct.Struct("<II")
+STRING = struct.Struct("<QI")
+RANGE = struct.Struct("<III")
+TIMED = struct.Struct("<iI")
+
+KIND_ENV = 0
+KIND_BEGIN_LOOP = 1
+KIND_END_LOOP = 2
+
+# keys of an env that are not program variables
+META_KEYS = {"time", "#", "$", "lineno", "prev_lineno", "next_lineno", "call", "sampled", "Net alloc", "Peak alloc", "begin_loop", "end_loop"}
+
+class StringHeap:
+	def __init__(self):
+		self.ids = {}
+		self.heap = bytearray()
+		self.table = bytearray()
+
+	def add(self, s):
+		sid = self.ids.get(s)
+		if sid == None:
+			sid = len(self.ids)
+			self.ids[s] = sid
+			b = s.encode()
+			self.table += STRING.pack(len(self.heap), len(b))
+			self.heap += b
+		return sid
+
+def env_kind(env):
+	if "begin_loop" in env:
+		return KIND_BEGIN_LOOP
+	if "end_loop" in env:
+		return KIND_END_LOOP
+	return KIND_ENV
+
+def write_trace(out, data):
+	strings = StringHeap()
+	events = bytearray()
+	bindings = bytearray()
+	lines = []
+	times = []
+	var_events = {}
+	n_events = 0
+	n_bindings = 0
+
+	for line_key in sorted(data, key = str):
+		envs = data[line_key]
+		key_id = strings.add(str(line_key))
+		lines.append((str(line_key), key_id, n_events, len(envs)))
+		# Loop markers have no time, so they are ordered in a line
+		# by the time of the env that precedes them
+		order = -1
+		for env in envs:
+			time = env.get("time", -1)
+			if time >= 0:
+				order = time
+			events += EVENT.pack(key_id, time, order, env_kind(env), n_bindings, len(env))
+			for k, v in env.items():
+				name_id = strings.add(k)
+				bindings += BINDING.pack(name_id, strings.add(json.dumps(v)))
+				if time >= 0 and not k in META_KEYS:
+					if not k in var_events:
+						var_events[k] = {}
+					# the same env can show up under several lines
+					var_events[k][time] = n_bindings
+				n_bindings += 1
+			if time >= 0:
+				times.append((time, n_events))
+			n_events += 1
+
+	lines.sort()
+	lines_section = b"".join(RANGE.pack(key_id, start, count) for (_, key_id, start, count) in lines)
+	times.sort()
+	times_section = b"".join(TIMED.pack(time, event) for (time, event) in times)
+
+	vars_section = bytearray()
+	var_events_section = bytearray()
+	n_var_events = 0
+	names = sorted(var_events)
+	for name in names:
+		by_time = var_events[name]
+		vars_section += RANGE.pack(strings.add(name), n_var_events, len(by_time))
+		for time in sorted(by_time):
+			var_events_section += TIMED.pack(time, by_time[time])
+		n_var_events += len(by_time)
+
+	sections = [
+		(events, n_events),
+		(bindings, n_bindings),
+		(strings.table, len(strings.ids)),
+		(strings.heap, len(strings.heap)),
+		(lines_section, len(lines)),
+		(times_section, len(times)),
+		(vars_section, len(names)),
+		(var_events_section, n_var_events),
+	]
+	offset = HEADER.size
+	header_fields = []
+	for (content, count) in sections:
+		header_fields += [offset, count]
+		offset += len(content)
+
+	out.write(HEADER.pack(MAGIC, VERSION, *header_fields))
+	for (content, _) in sections:
+		out.write(content)
+
+def lower_bound(lo, hi, key, value):
+	# first index i in [lo, hi) such that key(i) >= value
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if key(mid) < value:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+class TraceStore:
+	def __init__(self, path):
+		self.file = open(path, "rb")
+		self.mm = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		header = HEADER.unpack_from(self.mm, 0)
+		if header[0] != MAGIC or header[1] != VERSION:
+			raise ValueError("Not a trace store: " + path)
+		self.sections = {}
+		for i, name in enumerate(SECTIONS):
+			self.sections[name] = (header[2 + 2 * i], header[3 + 2 * i])
+		# only the line and variable tables are loaded, the rest is
+		# read from the mapping on demand
+		self.line_ranges = {}
+		for i in range(self.count("lines")):
+			(key_id, start, count) = self.record(RANGE, "lines", i)
+			self.line_ranges[self.string(key_id)] = (start, count)
+		self.var_ranges = {}
+		for i in range(self.count("vars")):
+			(name_id, start, count) = self.record(RANGE, "vars", i)
+			self.var_ranges[self.string(name_id)] = (start, count)
+
+	def close(self):
+		self.mm.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def count(self, section):
+		return self.sections[section][1]
+
+	def record(self, fmt, section, i):
+		return fmt.unpack_from(self.mm, self.sections[section][0] + i * fmt.size)
+
+	def string(self, sid):
+		(offset, length) = self.record(STRING, "strings", sid)
+		start = self.sections["heap"][0] + offset
+		return self.mm[start:start + length].decode()
+
+	def env(self, event):
+		(_, _, _, _, start, count) = self.record(EVENT, "events", event)
+		env = {}
+		for i in range(start, start + count):
+			(name_id, value_id) = self.record(BINDING, "bindings", i)
+			env[self.string(name_id)] = json.loads(self.string(value_id))
+		return env
+
+	def lines(self):
+		return list(self.line_ranges.keys())
+
+	def envs_at(self, line, t0 = None, t1 = None):
+		# envs for the given line (e.g. 5 or "R5"), optionally restricted
+		# to the ones in the time window [t0, t1]
+		line = str(line)
+		if not line in self.line_ranges:
+			return []
+		(start, count) = self.line_ranges[line]
+		end = start + count
+		order = lambda i: self.record(EVENT, "events", i)[2]
+		if t0 != None:
+			start = lower_bound(start, end, order, t0)
+		if t1 != None:
+			end = lower_bound(start, end, order, t1 + 1)
+		return [self.env(i) for i in range(start, end)]
+
+	def env_at(self, time):
+		n = self.count("times")
+		i = lower_bound(0, n, lambda i: self.record(TIMED, "times", i)[0], time)
+		if i == n:
+			return None
+		(t, event) = self.record(TIMED, "times", i)
+		if t != time:
+			return None
+		return self.env(event)
+
+	def values_of(self, varname, t0 = None, t1 = None):
+		# list of (time, value) of every env that binds varname
+		if not varname in self.var_ranges:
+			return []
+		(start, count) = self.var_ranges[varname]
+		end = start + count
+		time = lambda i: self.record(TIMED, "var_events", i)[0]
+		if t0 != None:
+			start = lower_bound(start, end, time, t0)
+		if t1 != None:
+			end = lower_bound(start, end, time, t1 + 1)
+		result = []
+		for i in range(start, end):
+			(t, binding) = self.record(TIMED, "var_events", i)
+			(_, value_id) = self.record(BINDING, "bindings", binding)
+			result.append((t, json.loads(self.string(value_id))))
+		return result
+
+def main(path, query, *args):
+	with TraceStore(path) as store:
+		if query == "lines":
+			result = store.lines()
+		elif query == "line":
+			bounds = [int(a) for a in args[1:]] + [None, None]
+			result = store.envs_at(args[0], bounds[0], bounds[1])
+		elif query == "time":
+			result = store.env_at(int(args[0]))
+		elif query == "var":
+			bounds = [int(a) for a in args[1:]] + [None, None]
+			result = store.values_of(args[0], bounds[0], bounds[1])
+		else:
+			print("Query not recognized: %s" % query)
+			exit(-1)
+	print(json.dumps(result))
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print("Usage: trace_store <trace-file> lines | line <lineno> [t0 t1] | time <t> | var <name> [t0 t1]")
+		exit(-1)
+	main(*sys.argv[1:])
@@ -1076,6 +1076,8 @@ export class RTVDisplayBox implements IRTVDisplayBox {
 					key !== 'next_lineno' &&
 					key !== 'lineno' &&
 					key !== 'time' &&
+					key !== 'call' &&
+					key !== 'sampled' &&
 					key !== '$' &&
 					key !== '#') {
 					this._allVars.add(key);
@@ -1686,6 +1688,9 @@ export class RTVController implements IRTVController {
 	public tableCellsByLoop: MapLoopsToCells = {};
 	public logger: IRTVLogger;
 	public pythonProcess?: RunProcess = undefined;
+	// Id of the run this.envs come from, for run.py to only send the lines
+	// that changed since then (see RUNPY_DIFF in the README)
+	private lastRunId?: string = undefined;
 	public utils: Utils = getUtils();
 	public runProgramDelay: DelayedRunAtMostOne = new DelayedRunAtMostOne();
 	public modelUpdated: boolean = false;
@@ -2117,7 +2122,7 @@ export class RTVController implements IRTVController {
 		if (e === undefined) {
 			return;
 		}
-		if (returnCode === 0 || returnCode === 2) {
+		if (returnCode === 0 || returnCode === 2 || returnCode === 3) {
 			this.changedLinesWhenOutOfDate = undefined;
 			return;
 		}
@@ -2229,6 +2234,8 @@ export class RTVController implements IRTVController {
 	}
 
 	private onDidChangeModel(e: IModelChangedEvent) {
+		// the next run can't be a diff against the envs of another model
+		this.lastRunId = undefined;
 		if (this._editor.getModel() !== null) {
 			this._boxes = [];
 			this._outputBox?.destroy();
@@ -2707,7 +2714,7 @@ export class RTVController implements IRTVController {
 		}
 
 		this.logger.projectionBoxUpdateStart(program);
-		this.pythonProcess = this.utils.runProgram(program, this.getCWD());
+		this.pythonProcess = this.utils.runProgram(program, this.getCWD(), undefined, this.lastRunId ?? 'new');
 
 		let runResults: RunResult = await this.pythonProcess;
 		const outputMsg = runResults.stdout;
@@ -2792,7 +2799,9 @@ export class RTVController implements IRTVController {
 		this.updateMaxPixelCol();
 		this.updateLinesWhenOutOfDate(returnCode, e);
 
-		if (returnCode === 0 || returnCode === 2) {
+		// 2: the program threw, 3: run.py stopped it (see RUNPY_TIMEOUT in
+		// the README). Both come with the data traced until then.
+		if (returnCode === 0 || returnCode === 2 || returnCode === 3) {
 			this.updateData(parsedResult);
 			this.clearError();
 		} else {
@@ -2841,7 +2850,7 @@ export class RTVController implements IRTVController {
 
 		this.updateLinesWhenOutOfDate(returnCode, e);
 
-		if (returnCode === 0 || returnCode === 2) {
+		if (returnCode === 0 || returnCode === 2 || returnCode === 3) {
 			this.updateData(parsedResult);
 			this.clearError();
 		} else {
@@ -2857,7 +2866,16 @@ export class RTVController implements IRTVController {
 
 	private updateData(parsedResult: any) {
 		this.writes = parsedResult[1];
+		const diff = parsedResult[3]?.diff;
+		if (diff && diff.base !== null && diff.base === this.lastRunId) {
+			// Only the changed and added lines were sent. The callers of
+			// updateBoxes get the merged envs too.
+			const envs = { ...this.envs };
+			diff.removed.forEach((line: string) => delete envs[line]);
+			parsedResult[2] = Object.assign(envs, parsedResult[2]);
+		}
 		this.envs = parsedResult[2];
+		this.lastRunId = diff?.run;
 	}
 
 	public getEnvAtNextTimeStep(env: any): any | null {
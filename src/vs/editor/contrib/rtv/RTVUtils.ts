@@ -129,7 +129,10 @@ class LocalSynthProcess implements SynthProcess {
 	constructor(protected logger?: IRTVLogger) {
 		this.logger?.synthProcessStart();
 
-		if (HEAP) {
+		if (SYNTH.endsWith('.py')) {
+			// synth.py in server mode speaks the same protocol
+			this._synthProcess = spawn(PY3, [SYNTH, '--server']);
+		} else if (HEAP) {
 			this._synthProcess = spawn(JAVA, [`-Xmx${HEAP}`, '-jar', SYNTH]);
 		} else {
 			this._synthProcess = spawn(JAVA, ['-jar', SYNTH]);
@@ -235,16 +238,19 @@ class LocalUtils implements Utils {
 		return this._logger;
 	}
 
-	runProgram(program: string, cwd?: string, values?: any): RunProcess {
+	runProgram(program: string, cwd?: string, values?: any, diffBase?: string): RunProcess {
 		const file: string = os.tmpdir() + path.sep + 'tmp.py';
 		fs.writeFileSync(file, program);
 
 		let local_process;
 
-		let options = undefined
+		let options: any = undefined
 		if (cwd) {
 			options = { cwd: cwd };
 		}
+		if (diffBase) {
+			options = { ...options, env: { ...process.env, RUNPY_DIFF: diffBase } };
+		}
 		if (values) {
 			const values_file: string = os.tmpdir() + path.sep + 'tmp_values.json';
 			fs.writeFileSync(values_file, JSON.stringify(values));